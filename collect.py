@@ -1,67 +1,119 @@
 import os
 import time
+import shutil
 import logging
 import knobtool.constants as my_constants
 
 from knobtool.workload import benchbase
 from knobtool.collector import Collector
+from knobtool.dataset import dataset_path
 from knobtool.knobs_manager import Knobs
 from rank import create_rank_info
+from rank import IncrementalRanker
 from knobtool.database.opengauss import GaussDB
 
 WORKLOAD = {"benchbase": benchbase.Benchbase}
 
 
-def collect(config, two_stage=False, result_path=None, candidates=None):
+def collect(config, two_stage=False, result_path=None, candidates=None, resume=False):
     wkld_cls = "benchbase"
 
     wkld_name = config["workload"]["name"].upper()
-    weights = config["workload"].get("weights", None)
+    wkld_options = {
+        "weights": config["workload"].get("weights", None),
+        "data_reset": config["workload"].get("data_reset", None),
+        "monitor_interval": config["workload"].get("monitor_interval", None),
+        "abort_grace": config["workload"].get("abort_grace", None),
+        "steady_window": config["workload"].get("steady_window", None),
+        "steady_tol": config["workload"].get("steady_tol", None),
+        "collect_stats": config["workload"].get("collect_stats", None),
+    }
+    options = {
+        "sample_size": config.get("sample_size"),
+        "init_num": config.get("init_num"),
+        "batch_size": config.get("batch_size"),
+        "early_abort": config.get("early_abort"),
+        "pipeline": config.get("pipeline"),
+        "queue_size": config.get("queue_size"),
+        "cache": config.get("cache"),
+        "repeat": config.get("repeat"),
+    }
     if candidates is None:
         with open(config["evaluate_knob"], "r") as f:
             context = f.readlines()
             candidates = [line.strip() for line in context if line.strip()[0] != "#"]
 
-    dbms = GaussDB.get_db(
-        name=my_constants.DB_NAME,
-        port=my_constants.DB_PORT,
-        knobs=knobs,
-    )
-    wkld_args = {
-        "weights": weights,
-        "db_port": dbms.port,
-        "db_user": dbms.db_user,
-        "db_passwd": dbms.db_passwd,
-        "db_name": dbms.db_name,
-    }
-    workload = WORKLOAD[wkld_cls](metric="through", workload=wkld_name, args=wkld_args)
-
     knobs = Knobs(
         knobs_csv_path=my_constants.DB_KNOBS_INFO,
         candidates=candidates,
     )
 
+    dbms, workload = _create_pool(knobs, wkld_cls, wkld_name, wkld_options)
+
     if two_stage:
         logging.info(f"{wkld_name} stage one start")
         tmp_path = os.path.join(
             config["file_dir"],
             "collect_tmp.csv",
         )
+        stage_one = config.get("stage_one") or {}
+        top_k = stage_one.get("top_k", 6)
+        ranker = None
+        if stage_one.get("early_stop"):
+            # screening stops once the top knobs no longer change, the first
+            # rank at min_rows and patience more updates every step rows
+            patience = stage_one.get("patience", 3)
+            step = stage_one.get("step", 5)
+            min_rows = stage_one.get("min_rows", 10)
+            if stage_one.get("size", 10) < min_rows + patience * step:
+                raise ValueError(
+                    f"stage_one early_stop needs size >= min_rows + patience * step "
+                    f"= {min_rows + patience * step}"
+                )
+            ranker = IncrementalRanker(
+                knobs,
+                workload[0].metric,
+                top_k=top_k,
+                patience=patience,
+                step=step,
+                min_rows=min_rows,
+            )
         data_file, total_list = _collect(
             knobs=knobs,
             dbms=dbms,
-            worklaod=workload,
-            size=10,
+            workload=workload,
+            size=stage_one.get("size", 10),
             result_path=tmp_path,
+            options=options if ranker is None else dict(options, monitor=ranker),
         )
         # create_rank_info
-        rank_res = create_rank_info(data_file).rank
-        candidates = [_ for _ in rank_res.keys()][:6]
+        if ranker is not None and ranker.stable:
+            rank_res = ranker.rank
+        else:
+            rank_res = create_rank_info(data_file).rank
+        candidates = [_ for _ in rank_res.keys()][:top_k]
         knobs = Knobs(
             knobs_csv_path=my_constants.DB_KNOBS_INFO,
             candidates=candidates,
         )
+        for db in dbms:
+            db.knobs = knobs
+            db.load_knobs_context()
         os.remove(tmp_path)
+        os.remove(tmp_path + ".meta")
+        shutil.rmtree(dataset_path(tmp_path), ignore_errors=True)
+
+        # stage one rows projected on the top knobs are kept in the dataset,
+        # stage two samples fill the gaps between them
+        options = dict(
+            options,
+            known_rows=[
+                row
+                for row in total_list
+                if row[workload[0].metric] not in (None, "")
+                and not int(row.get("censored") or 0)
+            ],
+        )
 
     # collect
     logging.info(f"{wkld_name} start")
@@ -72,6 +124,10 @@ def collect(config, two_stage=False, result_path=None, candidates=None):
         dbms=dbms,
         workload=workload,
         size=config["size"],
+        sample_policy=config.get("sample_policy") or "lhs",
+        seed=config.get("seeds") or 100,
+        resume=resume,
+        options=options,
         result_path=result_path
         if result_path is not None
         else os.path.join(
@@ -86,12 +142,49 @@ def collect(config, two_stage=False, result_path=None, candidates=None):
     return data_file, total_list
 
 
-def _collect(knobs, workload, size, result_path, sample_policy="lhs", seed=100):
-    dbms = GaussDB.get_db(
-        name=my_constants.DB_NAME,
-        port=my_constants.DB_PORT,
-        knobs=knobs,
-    )
+def _create_pool(knobs, wkld_cls, wkld_name, wkld_options):
+    """
+    one database & workload pair for each docker container, the default
+    container is used when no pool is configured.
+    """
+    pool = my_constants.DOCKER_POOL or [
+        {"name": my_constants.DOCKER_NAME, "port": my_constants.DB_PORT}
+    ]
+    dbms, workloads = [], []
+    for item in pool:
+        db = GaussDB.get_db(
+            name=item["name"],
+            port=item["port"],
+            knobs=knobs,
+        )
+        wkld_args = {
+            "db_port": db.port,
+            "db_user": db.db_user,
+            "db_passwd": db.db_passwd,
+            "db_name": db.db_name,
+        }
+        wkld_args.update(wkld_options)
+        dbms.append(db)
+        workloads.append(
+            WORKLOAD[wkld_cls](
+                metric="through", workload=wkld_name, args=wkld_args, ogdb=db
+            )
+        )
+    return dbms, workloads
+
+
+def _collect(
+    knobs,
+    dbms,
+    workload,
+    size,
+    result_path,
+    sample_policy="lhs",
+    seed=100,
+    resume=False,
+    options=None,
+):
     col_args = {"sample_policy": sample_policy, "seeds": seed}
+    col_args.update(options or {})
     col = Collector(knobs, dbms, workload, col_args)
-    return col.execute(num=size, result_path=result_path)
+    return col.execute(num=size, result_path=result_path, resume=resume)
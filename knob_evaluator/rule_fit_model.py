@@ -1,15 +1,22 @@
 import numpy as np
+import scipy.sparse as sp
 
 from functools import reduce
+from joblib import Parallel, delayed
+from sklearn.base import clone
 from sklearn.base import BaseEstimator
 from sklearn.base import TransformerMixin
 from sklearn.linear_model import LassoCV
 from sklearn.ensemble import (
     GradientBoostingRegressor,
     RandomForestRegressor,
-    RandomForestClassifier,
 )
 
+# the lasso is fit on the rule matrix as a csr below this share of non zero
+# entries or above this size of the dense float64 matrix, dense otherwise
+SPARSE_MAX_DENSITY = 0.1
+DENSE_MAX_BYTES = 2**30
+
 
 class RuleCondition:
     def __init__(self, feature_index, threshold, operator, support, feature_name=None):
@@ -97,87 +104,313 @@ class Rule:
         return self.__hash__() == other.__hash__()
 
 
-def extract_rules_from_tree(tree, feature_names=None):
-    rules = set()
-
-    def traverse_nodes(
-        node_id=0, operator=None, threshold=None, feature=None, conditions=[]
+def extract_rule_table(tree):
+    """
+    rules of the leaves of a fitted sklearn tree_, read from its node arrays
+    level by level without recursion. columnar table: feature, threshold,
+    le (<=) & support of the conditions, root first, an indptr from each
+    leaf rule to its conditions and the leaf values.
+    """
+    left, right = tree.children_left, tree.children_right
+    internal = np.flatnonzero(left != right)
+    parent = np.full(tree.node_count, -1, dtype=np.intp)
+    parent[left[internal]] = internal
+    parent[right[internal]] = internal
+    is_left = np.zeros(tree.node_count, dtype=bool)
+    is_left[left[internal]] = True
+    leaves = np.flatnonzero(left == right)
+    leaves = leaves[leaves != 0]
+
+    # climb from all leaves at once, a condition per edge to the parent
+    empty = np.zeros(0, dtype=np.intp)
+    rule_ids, nodes, levels = [empty], [empty], [empty]
+    rule, node, level = np.arange(len(leaves)), leaves, 0
+    while len(node) > 0:
+        rule_ids.append(rule)
+        nodes.append(node)
+        levels.append(np.full(len(node), level))
+        up = parent[node] != 0
+        rule, node, level = rule[up], parent[node[up]], level + 1
+    rule, node, level = map(np.concatenate, (rule_ids, nodes, levels))
+    order = np.lexsort((-level, rule))
+    rule, node = rule[order], node[order]
+
+    n_samples = tree.n_node_samples
+    indptr = np.zeros(len(leaves) + 1, dtype=np.intp)
+    indptr[1:] = np.cumsum(np.bincount(rule, minlength=len(leaves)))
+    return {
+        "feature": tree.feature[parent[node]],
+        "threshold": tree.threshold[parent[node]],
+        "le": is_left[node],
+        "support": n_samples[node] / float(n_samples[0]),
+        "indptr": indptr,
+        "value": tree.value[leaves, 0, 0],
+    }
+
+
+def _unique_rows(columns):
+    """
+    index of the first of each unique row of the columns, in sorted order,
+    and the unique row index of every row.
+    """
+    n = len(columns[0]) if len(columns) > 0 else 0
+    order = np.lexsort(columns[::-1]) if len(columns) > 0 else np.arange(n)
+    same = np.ones(max(n - 1, 0), dtype=bool)
+    for column in columns:
+        sorted_column = column[order]
+        same &= sorted_column[1:] == sorted_column[:-1]
+    new = np.concatenate([[True], ~same])[:n]
+    inverse = np.empty(n, dtype=np.intp)
+    inverse[order] = np.cumsum(new) - 1
+    # lexsort is stable, the first of a run is the earliest row
+    return order[new], inverse
+
+
+def compile_rule_tables(tables):
+    """
+    rule tables of several trees as arrays. the unique conditions
+    (features, thresholds, le for <=) with the support of the first node
+    each is found at, slots [n_rules, longest rule] of condition indices
+    padded with -1, and the support & value of each rule. a rule whose set
+    of conditions is already found is dropped, the first one is kept.
+    """
+    feature = np.concatenate([t["feature"] for t in tables] + [np.zeros(0, np.intp)])
+    threshold = np.concatenate([t["threshold"] for t in tables] + [np.zeros(0)])
+    le = np.concatenate([t["le"] for t in tables] + [np.zeros(0, bool)])
+    support = np.concatenate([t["support"] for t in tables] + [np.zeros(0)])
+    value = np.concatenate([t["value"] for t in tables] + [np.zeros(0)])
+    lengths = np.concatenate(
+        [np.diff(t["indptr"]) for t in tables] + [np.zeros(0, np.intp)]
+    )
+
+    first, inverse = _unique_rows([feature, threshold, le])
+    n_conditions = len(first)
+
+    # conditions of each rule sorted, a repeated one on a path is dropped,
+    # the padding (n_conditions until the end) sorts last
+    starts = np.cumsum(lengths) - lengths
+    rule = np.repeat(np.arange(len(lengths)), lengths)
+    slots = np.full([len(lengths), lengths.max(initial=0)], n_conditions, np.intp)
+    slots[rule, np.arange(len(rule)) - starts[rule]] = inverse
+    slots.sort(axis=1)
+    slots[:, 1:][slots[:, 1:] == slots[:, :-1]] = n_conditions
+    slots.sort(axis=1)
+    slots = slots[:, : (slots < n_conditions).sum(axis=1).max(initial=0)]
+
+    # a rule is as specific as its smallest node
+    rule_support = np.full(len(lengths), np.inf)
+    np.minimum.at(rule_support, rule, support)
+
+    keep = np.sort(_unique_rows(list(slots.T))[0])
+    slots = slots[keep]
+    slots[slots == n_conditions] = -1
+    return {
+        "features": feature[first],
+        "thresholds": threshold[first],
+        "le": le[first],
+        "condition_support": support[first],
+        "slots": slots,
+        "support": rule_support[keep],
+        "value": value[keep],
+    }
+
+
+def rule_objects(compiled, feature_names=None):
+    """
+    Rule objects of compiled rules, for inspection. the rules share one
+    RuleCondition per condition, each rule keeps its own support.
+    """
+    conditions = [
+        RuleCondition(
+            feature_index=f,
+            threshold=t,
+            operator="<=" if le else ">",
+            support=support,
+            feature_name=feature_names[f] if feature_names is not None else f,
+        )
+        for f, t, le, support in zip(
+            compiled["features"].tolist(),
+            compiled["thresholds"].tolist(),
+            compiled["le"].tolist(),
+            compiled["condition_support"].tolist(),
+        )
+    ]
+    rules = []
+    for slot, support, value in zip(
+        compiled["slots"].tolist(),
+        compiled["support"].tolist(),
+        compiled["value"].tolist(),
     ):
-        if node_id != 0:
-            if feature_names is not None:
-                feature_name = feature_names[feature]
-            else:
-                feature_name = feature
-            rule_condition = RuleCondition(
-                feature_index=feature,
-                threshold=threshold,
-                operator=operator,
-                support=tree.n_node_samples[node_id] / float(tree.n_node_samples[0]),
-                feature_name=feature_name,
-            )
-            new_conditions = conditions + [rule_condition]
-        else:
-            new_conditions = []
-        if tree.children_left[node_id] != tree.children_right[node_id]:
-            feature = tree.feature[node_id]
-            threshold = tree.threshold[node_id]
-
-            left_node_id = tree.children_left[node_id]
-            traverse_nodes(left_node_id, "<=", threshold, feature, new_conditions)
+        rule = Rule([conditions[j] for j in slot if j >= 0], value)
+        rule.support = support
+        rules.append(rule)
+    return rules
 
-            right_node_id = tree.children_right[node_id]
-            traverse_nodes(right_node_id, ">", threshold, feature, new_conditions)
-        elif len(new_conditions) > 0:
-            new_rule = Rule(new_conditions, tree.value[node_id][0][0])
-            rules.update([new_rule])
-            return None
 
-    traverse_nodes()
+def extract_rules_from_tree(tree, feature_names=None):
+    compiled = compile_rule_tables([extract_rule_table(tree)])
+    return set(rule_objects(compiled, feature_names))
+
+
+def evaluate_rules(X, features, thresholds, le, slots):
+    """
+    boolean matrix [n_samples, n_rules] of compiled rules: conditions
+    (features, thresholds, le for <=) and slots [n_rules, longest rule] of
+    condition indices, -1 for the always met condition.
+    """
+    if slots.shape[0] == 0:
+        return np.zeros([X.shape[0], 0], dtype=bool)
+    used, inverse = np.unique(slots, return_inverse=True)
+    inverse = inverse.reshape(slots.shape)
+    if used[0] == -1:
+        used = used[1:]
+    else:
+        inverse = inverse + 1
+    # condition major, row 0 is the always met condition
+    values = X.T[features[used]]
+    threshold = thresholds[used][:, None]
+    met = np.ones([len(used) + 1, X.shape[0]], dtype=bool)
+    met[1:] = np.where(le[used][:, None], values <= threshold, values > threshold)
+    res = met[inverse[:, 0]]
+    for k in range(1, slots.shape[1]):
+        res &= met[inverse[:, k]]
+    return res.T
+
+
+class CompactRuleFit:
+    """
+    fitted RuleFit reduced to arrays: the rules with non zero coefficient,
+    the conditions they share stored once, their coefficients & intercept.
+    """
+
+    def __init__(self, feature_names, features, thresholds, le, slots, coef, intercept):
+        self.feature_names = feature_names
+        self.features = features
+        self.thresholds = thresholds
+        self.le = le
+        self.slots = slots
+        self.coef_ = coef
+        self.intercept_ = intercept
 
-    return rules
+    def predict(self, X):
+        X_rules = evaluate_rules(X, self.features, self.thresholds, self.le, self.slots)
+        return X_rules @ self.coef_ + self.intercept_
 
 
 class RuleEnsemble:
     def __init__(self, tree_list, feature_names=None):
         self.tree_list = tree_list
         self.feature_names = feature_names
-        self.rules = set()
         self._extract_rules()
-        self.rules = list(self.rules)
 
     def _extract_rules(self):
-        for tree in self.tree_list:
-            rules = extract_rules_from_tree(
-                tree[0].tree_, feature_names=self.feature_names
-            )
-            self.rules.update(rules)
+        """
+        rules of all trees compiled to arrays, the Rule objects are built
+        only when rules is read.
+        """
+        compiled = compile_rule_tables(
+            [extract_rule_table(tree[0].tree_) for tree in self.tree_list]
+        )
+        self._condition_support = compiled["condition_support"]
+        self.features = compiled["features"]
+        self.thresholds = compiled["thresholds"]
+        self.le = compiled["le"]
+        self.slots = compiled["slots"]
+        self.support = compiled["support"]
+        self.value = compiled["value"]
+        self._rules = None
+
+    @property
+    def rules(self):
+        if self._rules is None:
+            compiled = {
+                "features": self.features,
+                "thresholds": self.thresholds,
+                "le": self.le,
+                "condition_support": self._condition_support,
+                "slots": self.slots,
+                "support": self.support,
+                "value": self.value,
+            }
+            self._rules = rule_objects(compiled, self.feature_names)
+        return self._rules
+
+    def __len__(self):
+        return self.slots.shape[0]
+
+    def _select(self, index):
+        self.slots = self.slots[index]
+        self.support = self.support[index]
+        self.value = self.value[index]
+        if self._rules is not None:
+            self._rules = [self._rules[i] for i in index]
 
     def filter_rules(self, func):
-        self.rules = filter(lambda x: func(x), self.rules)
+        self._select(np.flatnonzero([func(rule) for rule in self.rules]))
 
     def filter_short_rules(self, k):
-        self.filter_rules(lambda x: len(x.conditions) > k)
+        self._select(np.flatnonzero((self.slots >= 0).sum(axis=1) > k))
+
+    def _evaluate(self, X, rule_index=None):
+        """
+        boolean matrix [n_samples, n_rules] of the rules in rule_index (all
+        by default). each condition is checked once in one pass over X, then
+        the rules AND their k-th conditions for k up to the longest rule.
+        """
+        slots = self.slots if rule_index is None else self.slots[rule_index]
+        return evaluate_rules(X, self.features, self.thresholds, self.le, slots)
 
     def transform(self, X, coefs=None):
-        rule_list = list(self.rules)
         if coefs is None:
-            return np.array([rule.transform(X) for rule in rule_list]).T
+            return self._evaluate(X).astype(int)
         else:
-            res = np.array(
-                [
-                    rule_list[i_rule].transform(X)
-                    for i_rule in np.arange(len(rule_list))
-                    if coefs[i_rule] != 0
-                ]
-            ).T
-            res_ = np.zeros([X.shape[0], len(rule_list)])
-            res_[:, coefs != 0] = res
+            res_ = np.zeros([X.shape[0], len(self)])
+            res_[:, coefs != 0] = self._evaluate(X, np.flatnonzero(coefs != 0))
             return res_
 
+    def transform_sparse(self, X, chunk_size=None):
+        """
+        rule matrix as a csr matrix, evaluated chunk_size rows at a time so
+        the dense temporaries of a chunk stay within about 64MB.
+        """
+        n_rules = len(self)
+        if chunk_size is None:
+            # per row: float64 feature values & three boolean arrays for the
+            # conditions, the rule matrix & its gathered operand
+            n_conditions = len(self.features)
+            row_bytes = n_conditions * (8 + 3) + n_rules * 2
+            chunk_size = max(1, 2**26 // max(1, row_bytes))
+        # rule matrices are binary, only the active rule of each row is kept
+        # per chunk and the ones are filled in once
+        indices, counts = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.intp)]
+        for start in range(0, X.shape[0], chunk_size):
+            block = self._evaluate(X[start : start + chunk_size])
+            indices.append(np.nonzero(block)[1].astype(np.int32))
+            counts.append(block.sum(axis=1))
+        indices = np.concatenate(indices)
+        indptr = np.zeros(X.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(counts), out=indptr[1:])
+        data = np.ones(len(indices), dtype=np.float64)
+        return sp.csr_matrix((data, indices, indptr), shape=(X.shape[0], n_rules))
+
     def __str__(self):
         return (map(lambda x: x.__str__(), self.rules)).__str__()
 
 
+def _fit_tree(tree_generator, size, random_state, X, y, sample_weight=None):
+    """
+    grow one tree of at most size leaves with a copy of the forest params.
+    """
+    forest = clone(tree_generator).set_params(
+        n_estimators=1,
+        max_leaf_nodes=size,
+        random_state=random_state,
+        warm_start=False,
+        n_jobs=None,
+    )
+    return forest.fit(X, y, sample_weight=sample_weight).estimators_[0]
+
+
 class RuleFit(BaseEstimator, TransformerMixin):
     def __init__(
         self,
@@ -217,7 +450,15 @@ class RuleFit(BaseEstimator, TransformerMixin):
         self.rule_ensemble = None
         self.coef_ = {}
 
-    def fit(self, X, y, warm_start=False, tree_gen=None, feature_names=None):
+    def fit(
+        self,
+        X,
+        y,
+        warm_start=False,
+        tree_gen=None,
+        feature_names=None,
+        sample_weight=None,
+    ):
         if tree_gen is not None:
             self.tree_generator = tree_gen
         N = X.shape[0]
@@ -244,10 +485,12 @@ class RuleFit(BaseEstimator, TransformerMixin):
                 "RuleFit only works with RandomForest and BoostingRegressor"
             )
         if not self.exp_rand_tree_size:
-            self.tree_generator.fit(X, y)
+            self.tree_generator.fit(X, y, sample_weight=sample_weight)
         elif warm_start:
             self.tree_generator.set_params(warm_start=True)
-            self.tree_generator.fit(np.copy(X, order="C"), np.copy(y, order="C"))
+            self.tree_generator.fit(
+                np.copy(X, order="C"), np.copy(y, order="C"), sample_weight=sample_weight
+            )
             self.tree_generator.set_params(warm_start=False)
         else:
             np.random.seed(self.random_state)
@@ -263,34 +506,57 @@ class RuleFit(BaseEstimator, TransformerMixin):
             while np.sum(tree_sizes[0:i]) < self.max_rules:
                 i = i + 1
             tree_sizes = tree_sizes[0:i]
-            self.tree_generator.set_params(warm_start=True)
-            curr_est_ = 0
-            for i_size in np.arange(len(tree_sizes)):
-                size = tree_sizes[i_size]
-                self.tree_generator.set_params(n_estimators=curr_est_ + 1)
-                self.tree_generator.set_params(max_leaf_nodes=size)
-                random_state_add = self.random_state if self.random_state else 0
-                self.tree_generator.set_params(
-                    random_state=i_size + random_state_add
-                )  # warm_state=True seems to reset random_state, such that the trees are highly correlated, unless we manually change the random_sate here.
-                self.tree_generator.get_params()["n_estimators"]
-                self.tree_generator.fit(np.copy(X, order="C"), np.copy(y, order="C"))
-                curr_est_ = curr_est_ + 1
-            self.tree_generator.set_params(warm_start=False)
-            tree_list = self.tree_generator.estimators_
-            if isinstance(self.tree_generator, RandomForestRegressor) or isinstance(
-                self.tree_generator, RandomForestClassifier
-            ):
-                tree_list = [[x] for x in self.tree_generator.estimators_]
+            # one contiguous copy of the data in the float32 sklearn trees
+            # work on, shared by all the trees without further conversion
+            X_c = np.ascontiguousarray(X, dtype=np.float32)
+            y_c = np.ascontiguousarray(y, dtype=np.float64)
+            random_state_add = self.random_state if self.random_state else 0
+            if isinstance(self.tree_generator, RandomForestRegressor):
+                # forest trees are independent, grown in parallel threads
+                # (tree fitting releases the GIL), each seeded by its index,
+                # on all cores unless n_jobs is set
+                n_jobs = self.n_jobs if self.n_jobs is not None else -1
+                trees = Parallel(n_jobs=n_jobs, prefer="threads")(
+                    delayed(_fit_tree)(
+                        self.tree_generator,
+                        size,
+                        i_size + random_state_add,
+                        X_c,
+                        y_c,
+                        sample_weight,
+                    )
+                    for i_size, size in enumerate(tree_sizes)
+                )
+                tree_list = [[x] for x in trees]
+            else:
+                # boosting fits each tree on the residuals of the previous ones
+                self.tree_generator.set_params(warm_start=True)
+                curr_est_ = 0
+                for i_size in np.arange(len(tree_sizes)):
+                    size = tree_sizes[i_size]
+                    self.tree_generator.set_params(n_estimators=curr_est_ + 1)
+                    self.tree_generator.set_params(max_leaf_nodes=size)
+                    self.tree_generator.set_params(
+                        random_state=i_size + random_state_add
+                    )  # warm_state=True seems to reset random_state, such that the trees are highly correlated, unless we manually change the random_sate here.
+                    self.tree_generator.fit(X_c, y_c, sample_weight=sample_weight)
+                    curr_est_ = curr_est_ + 1
+                self.tree_generator.set_params(warm_start=False)
+                tree_list = self.tree_generator.estimators_
 
             self.rule_ensemble = RuleEnsemble(
                 tree_list=tree_list, feature_names=self.feature_names
             )
-            X_rules = self.rule_ensemble.transform(X, None)
-
-        X_concat = np.zeros([X.shape[0], 0])
-        if X_rules.shape[0] > 0:
-            X_concat = np.concatenate((X_concat, X_rules), axis=1)
+            X_rules = self.rule_ensemble.transform_sparse(X)
+            # lasso coordinate descent is several times slower on a csr than
+            # on the dense array, keep it sparse only when it is mostly zeros
+            # or too large to hold dense
+            n_cells = X_rules.shape[0] * X_rules.shape[1]
+            if (
+                X_rules.nnz >= SPARSE_MAX_DENSITY * n_cells
+                and n_cells * 8 <= DENSE_MAX_BYTES
+            ):
+                X_rules = X_rules.toarray()
 
         if self.Cs is None:
             n_alphas = 100
@@ -311,7 +577,7 @@ class RuleFit(BaseEstimator, TransformerMixin):
             n_jobs=self.n_jobs,
             random_state=self.random_state,
         )
-        self.lscv.fit(X_concat, y)
+        self.lscv.fit(X_rules, y, sample_weight=sample_weight)
         self.lscv_lists = self.lscv
         self.coef_ = self.lscv.coef_
         self.intercept_ = self.lscv.intercept_
@@ -320,7 +586,7 @@ class RuleFit(BaseEstimator, TransformerMixin):
 
     def predict(self, X):
         X_concat = np.zeros([X.shape[0], 0])
-        rule_coefs = self.coef_[-len(self.rule_ensemble.rules) :]
+        rule_coefs = self.coef_[-len(self.rule_ensemble) :]
         if len(rule_coefs) > 0:
             X_rules = self.rule_ensemble.transform(X, coefs=rule_coefs)
             if X_rules.shape[0] > 0:
@@ -329,3 +595,29 @@ class RuleFit(BaseEstimator, TransformerMixin):
 
     def transform(self, X=None):
         return self.rule_ensemble.transform(X)
+
+    def compact(self):
+        """
+        arrays only predictor of the rules with non zero coefficient, its
+        predict cost scales with their number.
+        """
+        ensemble = self.rule_ensemble
+        rule_coefs = np.asarray(self.coef_[-len(ensemble) :])
+        keep = np.flatnonzero(rule_coefs)
+        slots = ensemble.slots[keep]
+        # conditions of the kept rules, renumbered
+        used, inverse = np.unique(slots[slots >= 0], return_inverse=True)
+        slots = slots.copy()
+        slots[slots >= 0] = inverse
+        if slots.shape[0] > 0:
+            # drop padding columns no kept rule needs
+            slots = slots[:, : max(1, (slots >= 0).sum(axis=1).max())]
+        return CompactRuleFit(
+            feature_names=self.feature_names,
+            features=ensemble.features[used],
+            thresholds=ensemble.thresholds[used],
+            le=ensemble.le[used],
+            slots=slots,
+            coef=rule_coefs[keep].astype(np.float64),
+            intercept=self.intercept_,
+        )
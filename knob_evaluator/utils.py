@@ -7,34 +7,108 @@ import knobtool.constants as my_constants
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.ensemble import RandomForestRegressor
 from knobtool.knobs_manager import Knobs
+from knobtool.dataset import find_dataset, read_dataset
 from knob_evaluator.rule_fit_model import RuleFit
 
 
-def load_data(data_path, normalize=False, logarithmic=False):
-    knobs = None
+def load_data(
+    data_path,
+    normalize=False,
+    logarithmic=False,
+    drop_censored=False,
+    with_weights=False,
+):
+    """
+    with_weights also returns sample weights, the inverse variance of each
+    row's mean measured by repetition (None if not repeated).
+    """
+    knob_info = Knobs(knobs_csv_path=my_constants.DB_KNOBS_INFO)
+    store = find_dataset(data_path)
+    if store is not None:
+        X, y, schema, meta = read_dataset(store)
+        knobs, metric = schema["knobs"], schema["metric"]
+        keep = np.ones(len(y), dtype=bool)
+        if drop_censored and "censored" in meta:
+            keep = meta["censored"] == 0
+            X, y = X[keep], y[keep]
+        var = meta.get(f"{metric}_var")
+        repeat = meta.get("repeat")
+        if var is not None and repeat is not None:
+            # empty cells of censored / failed rows, as in _load_csv
+            var = np.nan_to_num(var[keep], nan=0.0)
+            repeat = np.nan_to_num(repeat[keep], nan=1.0)
+    else:
+        X, y, knobs, metric, var, repeat = _load_csv(data_path, knob_info, drop_censored)
+    weights = None
+    if with_weights and var is not None and repeat is not None:
+        weights = sample_weights(var, repeat)
+    if normalize:
+        X = knob_info.knob_normalization(X, knobs)
+        if logarithmic:
+            y = np.log(np.maximum(y, 1.0))
+        scaler = MinMaxScaler(feature_range=(0.1, 1))
+        scaler.fit([[max(y)], [min(y)]])
+        y_t = scaler.transform(y.reshape(-1, 1))
+        y = y_t.reshape(y.shape)
+    if with_weights:
+        return X, y, knobs, metric, weights
+    return X, y, knobs, metric
+
+
+def sample_weights(var, repeat, prior_dof=4, max_ratio=10):
+    """
+    inverse variance of the mean, repeat / var. the variance of a few runs
+    is noisy, so each row's variance is shrunk toward the pooled variance,
+    which counts as prior_dof degrees of freedom, and rows measured once
+    take the pooled variance. weights are clipped to [1 / max_ratio,
+    max_ratio] times their median, then normalized to mean 1.
+    """
+    var = np.asarray(var, dtype=np.float64)
+    repeat = np.asarray(repeat, dtype=np.float64)
+    dof = np.maximum(repeat - 1, 0)
+    if dof.sum() == 0:
+        return np.ones(len(var))
+    pooled = np.sum(dof * var) / dof.sum()
+    if pooled <= 0:
+        return np.ones(len(var))
+    var = (dof * var + prior_dof * pooled) / (dof + prior_dof)
+    weights = np.maximum(repeat, 1) / var
+    median = np.median(weights)
+    weights = np.clip(weights, median / max_ratio, median * max_ratio)
+    return weights / weights.mean()
+
+
+def _load_csv(data_path, knob_info, drop_censored=False):
     X = []
     y = []
+    knob_names = {ki["name"] for ki in knob_info.knobs_info}
     with open(data_path, "r") as file:
         reader = csv.reader(file)
         cols = next(reader)
-        knobs, metric = cols[1:-1], cols[-1]
+        # columns between index and metric which are not knobs are metadata
+        knob_index = [i for i in range(1, len(cols) - 1) if cols[i] in knob_names]
+        knobs, metric = [cols[i] for i in knob_index], cols[-1]
+        # runs aborted early by the collector are marked as censored
+        censored_index = cols.index("censored") if "censored" in cols else None
+        # variance & count of repeated measurements
+        var_index = cols.index(f"{metric}_var") if f"{metric}_var" in cols else None
+        repeat_index = cols.index("repeat") if "repeat" in cols else None
+        var, repeat = [], []
         for row in reader:
-            X.append(row[1:-1])
+            if drop_censored and censored_index is not None:
+                if int(row[censored_index] or 0):
+                    continue
+            X.append([row[i] for i in knob_index])
             y.append(row[-1])
+            if var_index is not None and repeat_index is not None:
+                var.append(float(row[var_index] or 0))
+                repeat.append(int(row[repeat_index] or 1))
     X, y = np.array(X), np.array(y)
-    knob_info = Knobs(knobs_csv_path=my_constants.DB_KNOBS_INFO)
     X = knob_info.enum_turn(X)
     X, y = X.astype(np.float64), y.astype(np.float64)
-    if normalize:
-        X = knob_info.knob_normalization(X, knobs)
-        if logarithmic:
-            y[y < 1] = 1.0
-            y = np.log(y)
-        scaler = MinMaxScaler(feature_range=(0.1, 1))
-        scaler.fit([[max(y)], [min(y)]])
-        y_t = scaler.transform(y.reshape(-1, 1))
-        return X, y_t.reshape(y.shape), knobs, metric
-    return X, y, knobs, metric
+    if var_index is None or repeat_index is None:
+        var, repeat = None, None
+    return X, y, knobs, metric, var, repeat
 
 
 def load_model(restore=False, model_path=None):
@@ -50,6 +124,6 @@ def save_model(model_path, model):
     pickle.dump(model, open(model_path, "wb"))
 
 
-def train_model(x_train, y_train, model, knobs):
-    model.fit(x_train, y_train, feature_names=knobs)
+def train_model(x_train, y_train, model, knobs, sample_weight=None):
+    model.fit(x_train, y_train, feature_names=knobs, sample_weight=sample_weight)
     return model
@@ -0,0 +1,81 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class MeasurementCache:
+    """
+    persistent cache of measured results, keyed by the knob config, the
+    workload and the database fingerprints and a hardware tag.
+    entries older than ttl seconds are ignored, ttl None never expires.
+    """
+
+    def __init__(self, path, ttl=None, hardware_tag=None) -> None:
+        self.path = path
+        self.ttl = ttl
+        if hardware_tag is None:
+            import socket
+
+            hardware_tag = socket.gethostname()
+        self.hardware_tag = hardware_tag
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS measurement "
+                "(key TEXT PRIMARY KEY, result TEXT, created REAL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    @staticmethod
+    def _canonical(value):
+        # 1024, 1024.0 and "1024" are the same knob value
+        try:
+            return format(float(value), ".12g")
+        except (TypeError, ValueError):
+            return str(value).strip()
+
+    def key(self, config: dict, fingerprint: dict):
+        content = {
+            "config": {name: self._canonical(v) for name, v in config.items()},
+            "fingerprint": fingerprint,
+            "hardware": self.hardware_tag,
+        }
+        text = json.dumps(content, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT result, created FROM measurement WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        if self.ttl is not None and time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO measurement VALUES (?, ?, ?)",
+                (key, json.dumps(result, default=float), time.time()),
+            )
+
+    def invalidate(self, key=None, older_than=None):
+        """
+        delete one entry, entries older than older_than seconds, or all.
+        """
+        with self._lock, self._connect() as conn:
+            if key is not None:
+                conn.execute("DELETE FROM measurement WHERE key = ?", (key,))
+            elif older_than is not None:
+                conn.execute(
+                    "DELETE FROM measurement WHERE created < ?",
+                    (time.time() - older_than,),
+                )
+            else:
+                conn.execute("DELETE FROM measurement")
@@ -1,15 +1,38 @@
+import io
+import os
 import csv
+import json
+import queue
 import logging
+import threading
+import numpy as np
 
-from knobtool.knobs_manager import Knobs
+from scipy.stats import t as t_dist
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from knobtool.cache import MeasurementCache
+from knobtool.dataset import import_csv
+from knobtool.knobs_manager import Knobs, process_list
+from knobtool.workload.steady_state import confidence_interval
 from knobtool.database.basicdb import BasicDB
 from knobtool.workload.basic_workload import BasicWorkload
-from knobtool.sample_policy import bucket_policy, lhs_policy
+from functools import partial
+from knobtool.sample_policy import (
+    adaptive_policy,
+    bucket_policy,
+    gap_fill_policy,
+    halton_policy,
+    lhs_policy,
+    sobol_policy,
+)
 
 
 class Collector:
     """
     collector, sample knob configs and collect data.
+    database and workload could also be lists of the same length, each
+    database paired with its own workload, samples are then dispatched
+    to the pool concurrently.
     """
 
     def __init__(
@@ -20,11 +43,43 @@ class Collector:
 
         # init knobs info from knobs csv and candidates file
         self.knobs = knobs
-        self.database = database
-        self.workload = workload
-        self.metric = workload.metric
+        self.databases = (
+            list(database) if isinstance(database, (list, tuple)) else [database]
+        )
+        self.workloads = (
+            list(workload) if isinstance(workload, (list, tuple)) else [workload]
+        )
+        if len(self.databases) != len(self.workloads):
+            raise ValueError(
+                f"got {len(self.databases)} databases but {len(self.workloads)} workloads"
+            )
+        self.database = self.databases[0]
+        self.workload = self.workloads[0]
+        self.metric = self.workload.metric
         self.args = args
 
+        # args["monitor"]: called with the rows after each one is recorded,
+        # returns True to stop the collection (e.g. rank.IncrementalRanker)
+        self.monitor = args.get("monitor")
+        self._stop = threading.Event()
+        self._monitor_lock = threading.Lock()
+
+        # measured results reused across runs, args["cache"]: {path, ttl, hardware_tag}
+        self.cache = None
+        if args.get("cache") and args["cache"].get("path"):
+            self.cache = MeasurementCache(
+                args["cache"]["path"],
+                ttl=args["cache"].get("ttl"),
+                hardware_tag=args["cache"].get("hardware_tag"),
+            )
+            self.fingerprint = {
+                "workload": self.workload.fingerprint(),
+                "database": self.database.fingerprint(),
+                # options that change the value or the columns of a row
+                "repeat": args.get("repeat"),
+                "early_abort": args.get("early_abort"),
+            }
+
         # knobs_list
         self.config_results = []  # cover by sample
 
@@ -33,90 +88,518 @@ class Collector:
             self.sample_method = lhs_policy
 
         elif args["sample_policy"] == "bucket":
-            self.sample_method = bucket_policy
+            # sample_size picks a random subset of the grid
+            self.sample_method = partial(bucket_policy, size=args.get("sample_size"))
+
+        elif args["sample_policy"] == "sobol":
+            self.sample_method = sobol_policy
+
+        elif args["sample_policy"] == "halton":
+            self.sample_method = halton_policy
+
+        elif args["sample_policy"] == "adaptive":
+            # seeded by lhs, the later batches are chosen in execute
+            self.sample_method = lhs_policy
         else:
             raise ValueError
 
-    def sample(self, num):
-        knobs = self.knobs
-        candidates_info = knobs.candidates_info
-
-        float_cans = [ci for ci in candidates_info if ci["category"] == "float"]
-        int_cans = [ci for ci in candidates_info if ci["category"] == "int"]
-        enum_cans = [ci for ci in candidates_info if ci["category"] == "enum"]
+        # rows measured before (e.g. stage one projected on these knobs),
+        # kept in the result and the lhs samples fill the gaps between them
+        self.known_rows = args.get("known_rows") or []
+        self.fill_gaps = len(self.known_rows) > 0 and self.sample_method is lhs_policy
+        if self.fill_gaps:
+            self.sample_method = partial(
+                gap_fill_policy, known=self._encode(self.known_rows)
+            )
 
-        # l_bounds, u_bounds need
-        l_bounds = [float(ci["lower_bound"]) for ci in candidates_info]
-        u_bounds = [float(ci["upper_bound"]) for ci in candidates_info]
+    def sample(self, num):
+        self.config_results = list(self.iter_sample(num))
+        return self.config_results
 
+    def iter_sample(self, num):
+        """
+        yield knob config dicts one by one, the sample policy may produce
+        one array or chunks of arrays lazily.
+        """
         # samples logits
         samples = self.sample_method(
-            len(knobs.candidates), num, seed=self.args["seeds"]
+            len(self.knobs.candidates), num, seed=self.args["seeds"]
+        )
+        if isinstance(samples, np.ndarray):
+            samples = [samples]
+        for chunk in samples:
+            yield from self.knobs.decoder.records(chunk)
+
+    def _decode(self, samples):
+        """
+        turn samples in [0,1] hypercubic into knob config dicts.
+        """
+        return list(self.knobs.decoder.records(samples))
+
+    def _encode(self, rows):
+        """
+        map knob config dicts back into [0,1] hypercubic, inverse of _decode.
+        """
+        return self.knobs.decoder.encode(rows)
+
+    def execute(
+        self, result_path, num=50, is_restart=True, is_clear_cache=False, resume=False
+    ):
+        """
+        measure the samples and append each row to result_path once done.
+        with resume, rows already in result_path are kept and their sample
+        indices are skipped, the seed & policy must be the same.
+        """
+        offset = len(self.known_rows)
+        new_num = max(num - offset, 0) if self.fill_gaps else num
+        if self.args["sample_policy"] == "adaptive":
+            init_num = self.args.get("init_num") or max(2, num // 5)
+            samples = self.iter_sample(num=max(min(init_num, num) - offset, 0))
+        else:
+            samples = self.iter_sample(num=new_num)
+
+        self._open_result(result_path, num, resume)
+        measured = {int(row[""]) for row in self.total_list}
+        if len(measured) > 0:
+            logging.info(f"resume {len(measured)} samples from {result_path}")
+        for i, row in enumerate(self.known_rows):
+            if i not in measured:
+                self._record(self._known_row(i, row))
+        todo = (
+            (i, s) for i, s in enumerate(samples, offset) if i not in measured
         )
 
-        from scipy.stats import qmc
-
-        samples = [spl for spl in qmc.scale(samples, l_bounds, u_bounds)]
-        # int & enum samples items
-        for spl_num in range(len(samples)):
-            spl = samples[spl_num].astype(object)
-            # float
-            findex = [candidates_info.index(fc) for fc in float_cans]
-            spl[findex] = [round(value, 2) for value in spl[findex]]
-            # int
-            iindex = [candidates_info.index(ic) for ic in int_cans]
-            spl[iindex] = [int(value) for value in spl[iindex]]
-            # enum
-            eindex = [candidates_info.index(ec) for ec in enum_cans]
-            spl[eindex] = [
-                self.process_list(candidates_info[index]["enum_choices"])[
-                    int(spl[index])
-                ]
-                for index in eindex
+        self._dispatch(self._until_stopped(todo), is_restart, is_clear_cache)
+
+        if self.args["sample_policy"] == "adaptive":
+            self._execute_adaptive(num, is_restart, is_clear_cache)
+
+        self.total_list.sort(key=lambda x: int(x[""]))
+        if result_path is not None and self.total_list:
+            # columnar copy of the csv, read by load_data without parsing
+            import_csv(result_path, knobs=self.knobs)
+        return result_path, self.total_list
+
+    def _until_stopped(self, todo):
+        for item in todo:
+            if self._stop.is_set():
+                logging.info(f"stopped by the monitor before sample {item[0]}")
+                return
+            yield item
+
+    def _execute_adaptive(self, num, is_restart, is_clear_cache):
+        """
+        after the lhs seed batch, pick the rest samples batch by batch
+        with the surrogate model fitted on measured rows.
+        """
+        batch_size = self.args.get("batch_size") or len(self.databases)
+        rounds = 0
+        while len(self.total_list) < num and not self._stop.is_set():
+            rows = [
+                row for row in self.total_list if row[self.metric] not in (None, "")
             ]
+            X = self._encode(rows)
+            y = np.array([float(row[self.metric]) for row in rows])
+            samples = adaptive_policy(
+                len(self.knobs.candidates),
+                min(batch_size, num - len(self.total_list)),
+                seed=self.args["seeds"] + rounds,
+                history=(X, y),
+                maximize=self.metric == "through",
+            )
+            start = max(int(row[""]) for row in self.total_list) + 1
+            todo = list(enumerate(self._decode(samples), start))
+            self._dispatch(todo, is_restart, is_clear_cache)
+            rounds += 1
 
-            # process finished, turn into dict
-            sample_dict = {}
-            for i, name in enumerate([ci["name"] for ci in candidates_info]):
-                sample_dict[name] = spl[i]
-            samples[spl_num] = sample_dict
+    def _dispatch(self, todo, is_restart, is_clear_cache):
+        if self.cache is not None:
+            todo = self._skip_cached(todo)
+        if len(self.databases) > 1 and self.args.get("pipeline"):
+            return self._dispatch_pipeline(todo, is_restart, is_clear_cache)
+        if len(self.databases) == 1:
+            for i, s in todo:
+                self._record(
+                    self._measure(
+                        i, s, self.database, self.workload, is_restart, is_clear_cache
+                    )
+                )
+            return
 
-        self.config_results = samples
-        return self.config_results
+        # pool of databases, one worker per container
+        idle = queue.Queue()
+        for k in range(len(self.databases)):
+            idle.put(k)
+
+        def _task(i, s):
+            k = idle.get()
+            try:
+                self._record(
+                    self._measure(
+                        i,
+                        s,
+                        self.databases[k],
+                        self.workloads[k],
+                        is_restart,
+                        is_clear_cache,
+                    )
+                )
+            finally:
+                idle.put(k)
 
-    def execute(self, result_path, num=50, is_restart=True, is_clear_cache=False):
-        samples = self.sample(num=num)
+        # samples are pulled from todo only when a container is about to be free
+        futures = []
+        with ThreadPoolExecutor(max_workers=len(self.databases)) as executor:
+            for i, s in todo:
+                while len(futures) >= len(self.databases):
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                    futures = [f for f in futures if f not in done]
+                futures.append(executor.submit(_task, i, s))
+            for future in futures:
+                future.result()
 
-        if type(samples[0]) != dict:
-            raise TypeError(
-                f"the sample type should be dict, but get {type(samples[0])}"
+    def _dispatch_pipeline(self, todo, is_restart, is_clear_cache):
+        """
+        prepare stage: one thread per container applies the next config,
+        benchmark stage: one thread runs the prepared containers in turn.
+        the restart of one container is hidden behind the benchmark on
+        another, stages are linked by bounded queues.
+        """
+        queue_size = self.args.get("queue_size") or len(self.databases)
+        samples = queue.Queue(maxsize=queue_size)
+        ready = queue.Queue(maxsize=queue_size)
+        errors = []
+
+        def _prepare(k):
+            released = threading.Event()
+            while True:
+                item = samples.get()
+                if item is None:
+                    ready.put(None)
+                    return
+                i, s = item
+                try:
+                    self._apply(s, self.databases[k], is_restart, is_clear_cache)
+                except Exception as e:
+                    logging.exception(f"{i} [{self.databases[k].name}] apply failed")
+                    errors.append(e)
+                    continue
+                released.clear()
+                ready.put((i, s, k, released))
+                # wait for the benchmark on this container
+                released.wait()
+
+        def _benchmark():
+            finished = 0
+            while finished < len(self.databases):
+                item = ready.get()
+                if item is None:
+                    finished += 1
+                    continue
+                i, s, k, released = item
+                try:
+                    self._record(
+                        self._benchmark(i, s, self.databases[k], self.workloads[k])
+                    )
+                except Exception as e:
+                    logging.exception(f"{i} [{self.databases[k].name}] benchmark failed")
+                    errors.append(e)
+                finally:
+                    released.set()
+
+        with ThreadPoolExecutor(max_workers=len(self.databases) + 1) as executor:
+            stages = [executor.submit(_prepare, k) for k in range(len(self.databases))]
+            stages.append(executor.submit(_benchmark))
+            for item in todo:
+                samples.put(item)
+            for _ in range(len(self.databases)):
+                samples.put(None)
+            for stage in stages:
+                stage.result()
+        if errors:
+            raise errors[0]
+
+    def _cache_key(self, s):
+        config = {ci["name"]: s[ci["name"]] for ci in self.knobs.candidates_info}
+        return self.cache.key(config, self.fingerprint)
+
+    def _skip_cached(self, todo):
+        """
+        record the cache hits at once and yield only the samples to measure.
+        """
+        for i, s in todo:
+            result = self.cache.get(self._cache_key(s))
+            if result is None:
+                yield i, s
+                continue
+            logging.info(f"{i} cached {self.metric}: {result[self.metric]}")
+            s.update(dict.fromkeys(getattr(self.database, "phase_time", {}), 0.0))
+            s.update(result.get("extra", {}))
+            self._record(self._finish_row(s, i, result[self.metric], cached=1))
+
+    def _known_row(self, i, row):
+        """
+        a row measured before, with the same columns as the measured ones.
+        """
+        names = [ci["name"] for ci in self.knobs.candidates_info]
+        s = {name: row[name] for name in names}
+        # knobs not sampled any more and flags are dropped
+        skipped = {ki["name"] for ki in self.knobs.knobs_info}
+        skipped.update(["", self.metric, "censored", "cached", "reused"])
+        columns = set(self._columns)
+        s.update(
+            {k: v for k, v in row.items() if k in columns and k not in skipped}
+        )
+        return self._finish_row(
+            s,
+            i,
+            row[self.metric],
+            censored=int(row.get("censored") or 0),
+            cached=int(row.get("cached") or 0),
+            reused=1,
+        )
+
+    def _row_columns(self):
+        """
+        columns of every row, fixed up front by the enabled features: the
+        index, knobs, restart phases, workload extras, repeat statistics,
+        flags and the metric as the last column.
+        """
+        columns = [""] + [ci["name"] for ci in self.knobs.candidates_info]
+        columns += list(getattr(self.database, "phase_time", {}))
+        columns += self.workload.extra_columns()
+        if self.args.get("repeat"):
+            columns += [f"{self.metric}_var", "repeat"]
+        if self.args.get("early_abort"):
+            columns.append("censored")
+        if self.cache is not None:
+            columns.append("cached")
+        if self.known_rows:
+            columns.append("reused")
+        columns.append(self.metric)
+        return columns
+
+    def _finish_row(self, s, i, value, censored=0, cached=0, reused=0):
+        # flag columns of the enabled features, then the metric as the last column
+        if self.args.get("early_abort"):
+            s["censored"] = censored
+        if self.cache is not None:
+            s["cached"] = cached
+        if self.known_rows:
+            s["reused"] = reused
+        s[self.metric], s[""] = value, i
+        return s
+
+    def _measure(self, i, s, database, workload, is_restart, is_clear_cache):
+        self._apply(s, database, is_restart, is_clear_cache)
+        return self._benchmark(i, s, database, workload)
+
+    def _apply(self, s, database, is_restart, is_clear_cache):
+        database.update(s, is_clear_cache=is_clear_cache, is_restart=is_restart)
+
+    def _benchmark(self, i, s, database, workload):
+        key = self._cache_key(s) if self.cache is not None else None
+        if self.args.get("early_abort"):
+            result = workload.evaluate(abort_below=self._abort_threshold())
+        else:
+            result = workload.evaluate()
+        if self.args.get("repeat"):
+            result = self._repeat(s, workload, result)
+        # censored results depend on the current baseline and failed runs
+        # should be measured again, neither is cached
+        if (
+            key is not None
+            and not result.get("censored")
+            and result[self.metric] is not None
+        ):
+            self.cache.put(
+                key,
+                {self.metric: result[self.metric], "extra": result.get("extra", {})},
             )
+        logging.info(f"{i} [{database.name}] {self.metric}: {result[self.metric]}")
+        # restart phases and workload extras, e.g. the measurement window,
+        # are kept before the metric, which stays the last column
+        s.update(getattr(database, "phase_time", {}))
+        s.update(result.get("extra", {}))
+        # add result
+        return self._finish_row(
+            s, i, result[self.metric], censored=int(bool(result.get("censored")))
+        )
 
-        total_list = []
-        for i, s in enumerate(samples):
-            self.database.update(
-                s, is_clear_cache=is_clear_cache, is_restart=is_restart
+    def _repeat(self, s, workload, result):
+        """
+        measure the config again while the confidence interval of its mean
+        is wider than ci_width (relative) or overlaps the nearest measured
+        configs, at most max times. the metric becomes the mean, its
+        variance and the repetition count are added as extras.
+        """
+        repeat = self.args["repeat"]
+        if result.get("censored") or result[self.metric] is None:
+            # aborted or failed run, nothing to repeat. the empty cells keep
+            # the columns of the repeated rows
+            result = dict(result)
+            result["extra"] = dict(result.get("extra", {}))
+            result["extra"].update({f"{self.metric}_var": None, "repeat": None})
+            return result
+        values = [result[self.metric]]
+        while len(values) < repeat.get("max", 3) and (
+            len(values) < repeat.get("min", 1) or self._need_repeat(s, values)
+        ):
+            value = workload.evaluate()[self.metric]
+            if value is None:
+                break
+            values.append(value)
+        result = dict(result)
+        result[self.metric] = float(np.mean(values))
+        result["extra"] = dict(result.get("extra", {}))
+        result["extra"][f"{self.metric}_var"] = (
+            float(np.var(values, ddof=1)) if len(values) > 1 else 0.0
+        )
+        result["extra"]["repeat"] = len(values)
+        return result
+
+    def _need_repeat(self, s, values):
+        repeat = self.args["repeat"]
+        confidence = repeat.get("confidence", 0.95)
+        low, high = confidence_interval(values, confidence)
+        mean = float(np.mean(values))
+        if len(values) < 2 or (high - low) / 2 > repeat.get("ci_width", 0.05) * abs(mean):
+            return True
+
+        neighbours = repeat.get("neighbours", 2)
+        with self._lock:
+            rows = [
+                row
+                for row in self.total_list
+                if row[self.metric] not in (None, "") and int(row.get("repeat") or 0) > 1
+            ]
+        if neighbours <= 0 or len(rows) == 0:
+            return False
+        distance = np.linalg.norm(self._encode(rows) - self._encode([s])[0], axis=1)
+        for j in np.argsort(distance)[:neighbours]:
+            # half width of the neighbour's interval from its variance and count
+            n_j = int(rows[j]["repeat"])
+            half_j = t_dist.ppf((1 + confidence) / 2, n_j - 1) * np.sqrt(
+                float(rows[j][f"{self.metric}_var"]) / n_j
             )
-            result = self.workload.evaluate()[self.metric]
-            logging.info(f"{i} {self.metric}: {result}")
-            # add result
-            s[self.metric], s[""] = result, i
-            total_list.append(s)
-            # record
-            if result_path is not None:
-                columns = [c for c in total_list[0].keys()]
-                columns.remove("")
-                columns = [""] + columns
-                with open(result_path, "w", newline="") as csvfile:
-                    writer = csv.DictWriter(csvfile, fieldnames=columns)
-                    writer.writeheader()
-                    writer.writerows(total_list)
-        return result_path, total_list
+            if abs(mean - float(rows[j][self.metric])) < (high - low) / 2 + half_j:
+                return True
+        return False
+
+    def _abort_threshold(self):
+        """
+        the throughput far below the measured ones, quantile of uncensored
+        rows scaled by ratio, None before min_samples rows are measured.
+        """
+        if self.metric != "through":
+            return None
+        early_abort = self.args["early_abort"]
+        with self._lock:
+            measured = [
+                float(row[self.metric])
+                for row in self.total_list
+                if row[self.metric] not in (None, "")
+                and not int(row.get("censored") or 0)
+            ]
+        if len(measured) < early_abort.get("min_samples", 10):
+            return None
+        return np.quantile(measured, early_abort.get("quantile", 0.25)) * early_abort.get(
+            "ratio", 0.5
+        )
+
+    def _open_result(self, result_path, num, resume):
+        self.result_path = result_path
+        self.total_list = []
+        self._columns = self._row_columns()
+        self._lock = threading.Lock()
+        if result_path is None:
+            return
+
+        meta = {
+            "sample_policy": self.args["sample_policy"],
+            "seeds": self.args["seeds"],
+            "num": num,
+            "knobs": [ci["name"] for ci in self.knobs.candidates_info],
+            "columns": self._columns,
+        }
+        meta_path = result_path + ".meta"
+        if resume and os.path.exists(result_path):
+            if os.path.exists(meta_path):
+                with open(meta_path, "r") as f:
+                    old_meta = json.load(f)
+                if old_meta != meta:
+                    raise ValueError(
+                        f"can not resume {result_path}, sampled with {old_meta}"
+                    )
+            self._read_result(result_path)
+        else:
+            # truncate old results, the header is written at once
+            with open(result_path, "w", newline="") as csvfile:
+                csv.writer(csvfile).writerow(self._columns)
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+    def _read_result(self, result_path):
+        """
+        load the rows of a partial result, its header must be the columns
+        of this run. a row torn by a crash (no line end or missing fields)
+        is cut off the file, its sample is measured again and the next row
+        starts on a new line.
+        """
+        with open(result_path, "rb") as f:
+            data = f.read()
+        complete = data[: data.rfind(b"\n") + 1]
+        lines = list(csv.reader(io.StringIO(complete.decode(), newline="")))
+        if lines:
+            if lines[0] != self._columns:
+                raise ValueError(
+                    f"can not resume {result_path}, its columns are {lines[0]}"
+                )
+            rows = [line for line in lines[1:] if len(line) == len(self._columns)]
+            self.total_list = [dict(zip(self._columns, line)) for line in rows]
+            if len(rows) == len(lines) - 1 and len(complete) == len(data):
+                return
+            torn = len(lines) - 1 - len(rows)
+            logging.info(f"drop {torn} torn rows of {result_path}")
+        if len(complete) < len(data):
+            logging.info(f"drop the unterminated last line of {result_path}")
+        tmp_path = result_path + ".tmp"
+        with open(tmp_path, "w", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(self._columns)
+            for row in self.total_list:
+                writer.writerow([row[c] for c in self._columns])
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+        os.replace(tmp_path, result_path)
+
+    def _record(self, row):
+        self._append(row)
+        self._notify()
+
+    def _append(self, row):
+        with self._lock:
+            self.total_list.append(row)
+            if self.result_path is None:
+                return
+            with open(self.result_path, "a", newline="") as csvfile:
+                # a row with columns outside the schema is an error
+                writer = csv.DictWriter(csvfile, fieldnames=self._columns)
+                writer.writerow(row)
+                csvfile.flush()
+                os.fsync(csvfile.fileno())
+
+    def _notify(self):
+        if self.monitor is None or self._stop.is_set():
+            return
+        with self._monitor_lock:
+            with self._lock:
+                rows = list(self.total_list)
+            if self.monitor(rows):
+                self._stop.set()
 
     @staticmethod
     def process_list(list_str):
-        # add quotes to item
-        list_str = list_str.strip()[1:-1]
-        items = list_str.split(",")
-        items = [item.strip() for item in items]
-        return items
+        return process_list(list_str)
@@ -12,16 +12,24 @@ DB_PASSWD = ""
 DB_BAK_FILE = ""
 DB_LOG_FILE = ""
 DB_KNOBS_INFO = ""
+DB_READY_TIMEOUT = 120  # seconds to wait for the database after restart
 
 # Docker config
 DOCKER_NAME = ""
 DOCKER_VOLUMN = ""
+DOCKER_POOL = []  # [{"name": ..., "port": ...}], containers for parallel collection
 
 # Workload config
 WORKLOAD_NAME = ""
 WORKLOAD_SCRIPT = ""
 WORKLOAD_TOOL_PATH = ""
 
+# Rank config
+RANK_WORKERS = None  # processes fitting the rank models, one per model if None
+RANK_TIMEOUT = None  # seconds per model, a number or {model: seconds}
+RANK_N_JOBS = None  # jobs of each permutation importance
+RANK_IMPORTANCE = {}  # {model: engine}, permutation if not given
+
 # System config: system user
 SYS_USER = ""
 SYS_PASSWD = ""
@@ -1,13 +1,44 @@
 import os
 import time
+import hashlib
 import logging
 import psycopg2
+import threading
 import subprocess
 
 from typing import Union
 from knobtool import constants as my_constants
 from knobtool.database.basicdb import BasicDB
 
+# knobs in these contexts take effect by pg_reload_conf, others need a restart
+RELOAD_CONTEXTS = {"sighup", "superuser", "user", "superuser-backend", "backend"}
+
+# cumulative runtime counters snapshot around a benchmark run, column -> sql
+STAT_COLUMNS = {
+    "xact_commit": "d.xact_commit",
+    "xact_rollback": "d.xact_rollback",
+    "blks_read": "d.blks_read",
+    "blks_hit": "d.blks_hit",
+    "tup_returned": "d.tup_returned",
+    "tup_fetched": "d.tup_fetched",
+    "tup_inserted": "d.tup_inserted",
+    "tup_updated": "d.tup_updated",
+    "tup_deleted": "d.tup_deleted",
+    "conflicts": "d.conflicts",
+    "temp_files": "d.temp_files",
+    "temp_bytes": "d.temp_bytes",
+    "deadlocks": "d.deadlocks",
+    "blk_read_time": "d.blk_read_time",
+    "blk_write_time": "d.blk_write_time",
+    "buffers_clean": "b.buffers_clean",
+    "maxwritten_clean": "b.maxwritten_clean",
+    "buffers_alloc": "b.buffers_alloc",
+    "heap_blks_read": "io.heap_blks_read",
+    "heap_blks_hit": "io.heap_blks_hit",
+    "idx_blks_read": "io.idx_blks_read",
+    "idx_blks_hit": "io.idx_blks_hit",
+}
+
 
 class GaussDB(BasicDB):
     # Friendly with PG
@@ -38,22 +69,67 @@ class GaussDB(BasicDB):
         self.db_passwd = db_passwd
         self.sys_user = sys_user
         self.sys_passwd = sys_passwd
+        # knob config currently applied to the container, unknown at first
+        self.applied = None
+        # seconds spent to apply the last config
+        self.phase_time = {"stop_time": 0.0, "start_time": 0.0, "ready_time": 0.0}
+        # connections kept across statements, keyed by (database, autocommit)
+        self._conns = {}
+        self._conn_lock = threading.RLock()
 
         self.create_database_if_not_exists(self.db_name)
+        self.load_knobs_context()
 
     def update(self, sample: Union[dict, str], is_clear_cache=False, is_restart=True):
         """
         create config file and write to local docker container.
+        the config is applied by reload if no postmaster knob changed,
+        otherwise by restart.
         """
         if sample == "default":
             context = self._output(sample, is_default=True)
+            config = {}
         else:
             context = self._output(sample)
+            config = {
+                ci["name"]: sample[ci["name"]] for ci in self.knobs.candidates_info
+            }
 
         self._produce_config(context)
 
+        self.phase_time = {"stop_time": 0.0, "start_time": 0.0, "ready_time": 0.0}
         if is_restart:
-            self.restart()
+            reload_start = time.time()
+            if self._need_restart(config) or not self.refresh():
+                self.restart()
+            else:
+                self.phase_time["ready_time"] = round(time.time() - reload_start, 3)
+                logging.info(f" -- container {self.name} reloaded")
+        self.applied = config
+
+    def load_knobs_context(self):
+        res = self._exec_fetch("SELECT name, context FROM pg_settings;")
+        if res:
+            self.knobs.update_context({name: context for name, context in res})
+
+    def _need_restart(self, config):
+        if self.applied is None:
+            return True
+        changed = [
+            name
+            for name in set(config) | set(self.applied)
+            if config.get(name) != self.applied.get(name)
+        ]
+        return any(
+            self.knobs.knobs_context.get(name) not in RELOAD_CONTEXTS
+            for name in changed
+        )
+
+    def fingerprint(self):
+        """
+        identify the base config every sample is written upon.
+        """
+        return {"base_conf": hashlib.sha256(self.bak.encode()).hexdigest()}
 
     def _load_default(self, back_path):
         if os.path.exists(back_path):
@@ -118,35 +194,90 @@ class GaussDB(BasicDB):
             timeout=None,
         )
 
-    def _exec_only(self, statement, database="postgres", autocommit=False):
-        try:
+    def _connect(self, database="postgres", autocommit=False):
+        """
+        reuse the connection kept for (database, autocommit), reconnect if
+        it is closed, e.g. after the container restarted.
+        """
+        key = (database, autocommit)
+        conn = self._conns.get(key)
+        if conn is None or conn.closed:
             conn = psycopg2.connect(
                 f"dbname={database} user={self.db_user} password={self.db_passwd} host={self.db_host} port={self.port}"
             )
             conn.autocommit = autocommit
-            cur = conn.cursor()
-            cur.execute(statement)
-            conn.close()
+            self._conns[key] = conn
+        return conn
+
+    def close(self):
+        with self._conn_lock:
+            for conn in self._conns.values():
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._conns = {}
+
+    def _run(
+        self, statements, fetch=False, one=False, database="postgres", autocommit=False
+    ):
+        """
+        execute statements on the kept connection, in one transaction if not
+        autocommit. a broken connection is dropped and retried once.
+        """
+        with self._conn_lock:
+            for attempt in range(2):
+                conn = self._connect(database, autocommit)
+                try:
+                    res = []
+                    with conn.cursor() as cur:
+                        for statement in statements:
+                            cur.execute(statement)
+                            if not fetch or cur.description is None:
+                                res.append(None)
+                            else:
+                                res.append(cur.fetchone() if one else cur.fetchall())
+                    if not autocommit:
+                        conn.commit()
+                    return res
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    # stale connection, the server may have restarted
+                    conn.close()
+                    self._conns.pop((database, autocommit), None)
+                    if attempt == 1:
+                        raise
+                except Exception:
+                    if not conn.closed and not autocommit:
+                        conn.rollback()
+                    raise
+
+    def _exec_only(self, statement, database="postgres", autocommit=False):
+        try:
+            self._run([statement], database=database, autocommit=autocommit)
         except Exception:
             return False
         return True
 
     def _exec_fetch(self, statement, one=False, database="postgres", autocommit=False):
         try:
-            conn = psycopg2.connect(
-                f"dbname={database} user={self.db_user} password={self.db_passwd} host={self.db_host} port={self.port}"
+            res = self._run(
+                [statement], fetch=True, one=one, database=database, autocommit=autocommit
             )
-            cur = conn.cursor()
-            cur.execute(statement)
-            if not one:
-                res = cur.fetchall()
-            else:
-                res = cur.fetchone()
-            conn.close()
         except Exception as e:
             logging.info(e)
             return None
-        return res
+        return res[0]
+
+    def exec_batch(self, statements, one=False, database="postgres"):
+        """
+        execute statements in one transaction on the kept connection,
+        return the fetched result of each statement, None if failed.
+        """
+        try:
+            return self._run(statements, fetch=True, one=one, database=database)
+        except Exception as e:
+            logging.info(e)
+            return None
 
     def create_database_if_not_exists(self, database):
         res = self._exec_fetch(
@@ -158,16 +289,82 @@ class GaussDB(BasicDB):
         if not res:
             self._exec_only("CREATE DATABASE {};".format(database), autocommit=True)
 
+    def snapshot_stats(self):
+        """
+        read the runtime counters of STAT_COLUMNS in a single query,
+        pg_statio_user_tables is per database so it runs in db_name.
+        """
+        columns = ", ".join(
+            f"{expr} AS {name}" for name, expr in STAT_COLUMNS.items()
+        )
+        res = self._exec_fetch(
+            f"SELECT {columns} FROM pg_stat_database d, pg_stat_bgwriter b, "
+            "(SELECT coalesce(sum(heap_blks_read), 0) AS heap_blks_read, "
+            "coalesce(sum(heap_blks_hit), 0) AS heap_blks_hit, "
+            "coalesce(sum(idx_blks_read), 0) AS idx_blks_read, "
+            "coalesce(sum(idx_blks_hit), 0) AS idx_blks_hit "
+            f"FROM pg_statio_user_tables) io WHERE d.datname = '{self.db_name}';",
+            one=True,
+            database=self.db_name,
+        )
+        if res is None:
+            return None
+        return {name: float(value or 0) for name, value in zip(STAT_COLUMNS, res)}
+
+    def _terminate_connections(self, *databases):
+        names = ", ".join(f"'{database}'" for database in databases)
+        return self._exec_only(
+            "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+            f"WHERE datname IN ({names}) AND pid <> pg_backend_pid();",
+            autocommit=True,
+        )
+
+    def snapshot_database(self, database, template):
+        """
+        keep a copy of database as template, used to restore loaded data.
+        """
+        self._terminate_connections(database, template)
+        self._exec_only(f"DROP DATABASE IF EXISTS {template};", autocommit=True)
+        return self._exec_only(
+            f"CREATE DATABASE {template} TEMPLATE {database};", autocommit=True
+        )
+
+    def restore_database(self, database, template):
+        """
+        recreate database from the template made by snapshot_database.
+        """
+        self._terminate_connections(database, template)
+        self._exec_only(f"DROP DATABASE IF EXISTS {database};", autocommit=True)
+        return self._exec_only(
+            f"CREATE DATABASE {database} TEMPLATE {template};", autocommit=True
+        )
+
     def refresh(self):
         return self._exec_only("SELECT pg_reload_conf();")
 
     def touch(self):
-        return self._exec_only(
-            "select pg_database.datname, pg_database_size(pg_database.datname) AS size from pg_database;"
-        )
+        return self._exec_only("SELECT 1;")
 
-    def restart(self, time_bound=20):
+    def wait_ready(self, time_bound, interval=0.05, max_interval=2.0):
+        """
+        poll the database with exponential backoff until it accepts
+        connections, return False if time_bound seconds passed.
+        """
+        record_time = time.time()
+        while True:
+            if self.touch():
+                return True
+            remain = time_bound - (time.time() - record_time)
+            if remain <= 0:
+                return False
+            time.sleep(min(interval, remain))
+            interval = min(interval * 2, max_interval)
+
+    def restart(self, time_bound=None):
+        if time_bound is None:
+            time_bound = my_constants.DB_READY_TIMEOUT
         logging.info(f" -- container {self.name} restarting")
+        self.close()
 
         # first stop
         stop_start = time.time()
@@ -188,12 +385,17 @@ class GaussDB(BasicDB):
             text=True,
             capture_output=True,
         )
-        record_time = time.time()
-        while time.time() - record_time < time_bound:
-            time.sleep(10)
-            state = self.touch()
-            if state:
-                logging.info(f" -- restart {self.name} with {time.time()-record_time}")
-                return True
-            logging.info(f" -- waiting for {self.name} {time.time()-record_time}")
-        return False
+        start_finish = time.time()
+        state = self.wait_ready(time_bound)
+        ready_finish = time.time()
+        self.phase_time = {
+            "stop_time": round(stop_finish - stop_start, 3),
+            "start_time": round(start_finish - stop_finish, 3),
+            "ready_time": round(ready_finish - start_finish, 3),
+        }
+        if not state:
+            raise TimeoutError(
+                f"container {self.name} is not ready after {time_bound}s"
+            )
+        logging.info(f" -- restart {self.name} with {ready_finish-stop_finish}")
+        return True
@@ -0,0 +1,131 @@
+"""
+columnar dataset of collected samples, a directory holding
+
+    schema.json     knobs, knob types, enum mapping, metric, meta columns
+    X.npy           float64 [n, knobs], enum knobs turned into int
+    y.npy           float64 [n], the metric
+    index.npy       int64 [n], sample index
+    meta_<c>.npy    one array per metadata column, e.g. restart time
+
+arrays are loaded memory-mapped, so reading does not copy or parse.
+"""
+import os
+import csv
+import sys
+import json
+import shutil
+import numpy as np
+import knobtool.constants as my_constants
+
+from knobtool.knobs_manager import Knobs
+
+SCHEMA_VERSION = 1
+
+
+def dataset_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ".dataset"
+
+
+def _to_float(values):
+    return np.array([float(v) if v not in ("", "None") else np.nan for v in values])
+
+
+def import_csv(csv_path, out_path=None, knobs=None):
+    """
+    convert a collected csv (index, knobs..., metadata..., metric) into
+    the columnar dataset, return the dataset path.
+    """
+    if out_path is None:
+        out_path = dataset_path(csv_path)
+    if knobs is None:
+        knobs = Knobs(knobs_csv_path=my_constants.DB_KNOBS_INFO)
+    knob_types = {ki["name"]: ki["category"] for ki in knobs.knobs_info}
+
+    with open(csv_path, "r", newline="") as f:
+        reader = csv.reader(f)
+        cols = next(reader)
+        rows = [row for row in reader if row]
+    knob_index = [i for i in range(1, len(cols) - 1) if cols[i] in knob_types]
+    meta_index = [i for i in range(1, len(cols) - 1) if cols[i] not in knob_types]
+
+    X = np.array([[row[i] for i in knob_index] for row in rows]).reshape(
+        len(rows), len(knob_index)
+    )
+    X = knobs.enum_turn(X).astype(np.float64)
+    y = _to_float([row[-1] for row in rows])
+    index = np.array([int(row[0]) for row in rows], dtype=np.int64)
+
+    meta = {}
+    for i in meta_index:
+        values = [row[i] for row in rows]
+        try:
+            meta[cols[i]] = _to_float(values)
+        except ValueError:
+            meta[cols[i]] = np.array(values, dtype=str)
+
+    schema = {
+        "version": SCHEMA_VERSION,
+        "knobs": [cols[i] for i in knob_index],
+        "types": [knob_types[cols[i]] for i in knob_index],
+        "enum_map": knobs.enum_turn_to_int,
+        "metric": cols[-1],
+        "rows": len(rows),
+        "meta": list(meta.keys()),
+        "source": os.path.basename(csv_path),
+    }
+    write_dataset(out_path, X, y, index, schema, meta)
+    return out_path
+
+
+def write_dataset(path, X, y, index, schema, meta=None):
+    # write aside and swap, readers never see a half written dataset
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "X.npy"), np.ascontiguousarray(X))
+    np.save(os.path.join(tmp_path, "y.npy"), np.ascontiguousarray(y))
+    np.save(os.path.join(tmp_path, "index.npy"), np.ascontiguousarray(index))
+    for name, values in (meta or {}).items():
+        np.save(os.path.join(tmp_path, f"meta_{name}.npy"), values)
+    with open(os.path.join(tmp_path, "schema.json"), "w") as f:
+        json.dump(schema, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def read_dataset(path, mmap=True):
+    """
+    return X, y, schema, meta of the dataset, arrays are memory-mapped.
+    """
+    mmap_mode = "r" if mmap else None
+    with open(os.path.join(path, "schema.json"), "r") as f:
+        schema = json.load(f)
+    if schema.get("version") != SCHEMA_VERSION:
+        raise ValueError(f"unknown dataset version {schema.get('version')} in {path}")
+    X = np.load(os.path.join(path, "X.npy"), mmap_mode=mmap_mode)
+    y = np.load(os.path.join(path, "y.npy"), mmap_mode=mmap_mode)
+    meta = {
+        name: np.load(os.path.join(path, f"meta_{name}.npy"), mmap_mode=mmap_mode)
+        for name in schema["meta"]
+    }
+    meta["index"] = np.load(os.path.join(path, "index.npy"), mmap_mode=mmap_mode)
+    return X, y, schema, meta
+
+
+def find_dataset(data_path):
+    """
+    the dataset to read for data_path, itself if it is a dataset or the
+    dataset converted from the csv if it is up to date, else None.
+    """
+    if os.path.isdir(data_path):
+        return data_path
+    store = dataset_path(data_path)
+    if os.path.isdir(store) and os.path.getmtime(store) >= os.path.getmtime(data_path):
+        return store
+    return None
+
+
+if __name__ == "__main__":
+    # python -m knobtool.dataset <collected csv> <knobs info csv>
+    my_constants.DB_KNOBS_INFO = sys.argv[2]
+    print(import_csv(sys.argv[1]))
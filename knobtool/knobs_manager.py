@@ -4,6 +4,78 @@ import numpy as np
 from sklearn.preprocessing import MinMaxScaler
 
 
+def process_list(list_str):
+    # add quotes to item
+    list_str = list_str.strip()[1:-1]
+    items = list_str.split(",")
+    items = [item.strip() for item in items]
+    return items
+
+
+class KnobDecoder:
+    """
+    map samples in [0,1] hypercubic to typed knob values and back,
+    compiled once from candidates_info so a whole sample matrix is
+    decoded column by column.
+    """
+
+    def __init__(self, candidates_info) -> None:
+        self.names = [ci["name"] for ci in candidates_info]
+        categories = [ci["category"] for ci in candidates_info]
+        self.lower = np.array([float(ci["lower_bound"]) for ci in candidates_info])
+        self.upper = np.array([float(ci["upper_bound"]) for ci in candidates_info])
+        self.float_index = [i for i, c in enumerate(categories) if c == "float"]
+        self.int_index = [i for i, c in enumerate(categories) if c == "int"]
+        self.enum_index = [i for i, c in enumerate(categories) if c == "enum"]
+        self.enum_choices = {
+            i: np.array(process_list(candidates_info[i]["enum_choices"]), dtype=object)
+            for i in self.enum_index
+        }
+
+    def decode(self, samples):
+        """
+        samples [n, d] in [0,1] -> {knob name: list of n typed values}
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        values = self.lower + samples * (self.upper - self.lower)
+        columns = {}
+        if self.float_index:
+            floats = np.round(values[:, self.float_index], 2)
+            for i, col in zip(self.float_index, floats.T.tolist()):
+                columns[self.names[i]] = col
+        if self.int_index:
+            ints = np.trunc(values[:, self.int_index]).astype(np.int64)
+            for i, col in zip(self.int_index, ints.T.tolist()):
+                columns[self.names[i]] = col
+        for i in self.enum_index:
+            choices = self.enum_choices[i]
+            idx = np.clip(values[:, i].astype(np.int64), 0, len(choices) - 1)
+            columns[self.names[i]] = choices[idx].tolist()
+        return columns
+
+    def records(self, samples):
+        """
+        yield one {knob name: value} dict per sample.
+        """
+        columns = self.decode(samples)
+        cols = [columns[name] for name in self.names]
+        for values in zip(*cols):
+            yield dict(zip(self.names, values))
+
+    def encode(self, rows):
+        """
+        map knob config dicts back into [0,1] hypercubic, inverse of decode.
+        """
+        X = np.zeros((len(rows), len(self.names)))
+        for i, name in enumerate(self.names):
+            if i in self.enum_choices:
+                choices = self.enum_choices[i].tolist()
+                X[:, i] = [choices.index(str(row[name])) + 0.5 for row in rows]
+            else:
+                X[:, i] = [float(row[name]) - self.lower[i] for row in rows]
+        return np.clip(X / (self.upper - self.lower), 0, 1)
+
+
 class Knobs:
     def __init__(self, knobs_csv_path, candidates=None) -> None:
         # knobs name upper lower bound file
@@ -15,6 +87,12 @@ class Knobs:
         self.all_knobs_default = {}
         self.enum_choices = []
         self.enum_turn_to_int = {"off": 0, "on": 1}
+        # knob context (postmaster, sighup, user...) decides how to apply it
+        self.knobs_context = {
+            row["name"]: row["context"]
+            for row in self.knobs_info
+            if row.get("context")
+        }
         self.candidates = candidates
         # knob range and enum choices for turn enum to int
         for row in self.knobs_info:
@@ -38,13 +116,27 @@ class Knobs:
 
     @candidates.setter
     def candidates(self, value):
-        self._candidates = value
+        self._candidates = value if value is not None else []
         knobs = [ki["name"] for ki in self.knobs_info]
         if not all([cand in knobs for cand in self._candidates]):
             raise ValueError("eval knobs not found")
         self.candidates_info = [
             ki for ki in self.knobs_info if ki["name"] in self._candidates
         ]
+        self._decoder = None
+
+    @property
+    def decoder(self):
+        if self._decoder is None:
+            self._decoder = KnobDecoder(self.candidates_info)
+        return self._decoder
+
+    def update_context(self, knobs_context: dict):
+        """
+        fill the knob context missing in knobs csv, e.g. from pg_settings.
+        """
+        for name, context in knobs_context.items():
+            self.knobs_context.setdefault(name, context)
 
     def knob_normalization(self, knob_data, knobs):
         min_values = [self.all_knobs_range[knob][0] for knob in knobs]
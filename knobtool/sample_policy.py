@@ -20,11 +20,133 @@ def lhs_policy(knobs_num, block_num, seed=None):
     return samples
 
 
-def bucket_policy(knobs_num, block_num, seed=None):
+def gap_fill_policy(knobs_num, block_num, seed=None, known=None, candidate_num=None):
+    """fill the gaps between known points in [0,1] hypercubic.
+    lhs candidates are picked greedily by the largest distance to the
+    known points and the points picked before (maximin).
+    """
+    if known is None or len(known) == 0:
+        return lhs_policy(knobs_num, block_num, seed=seed)
+    if candidate_num is None:
+        candidate_num = max(1000, 20 * block_num)
+    candidates = lhs_policy(knobs_num, candidate_num, seed=seed)
+    known = np.asarray(known, dtype=float)
+
+    # distance from each candidate to its nearest chosen point
+    nearest = np.min(
+        np.linalg.norm(candidates[:, None, :] - known[None, :, :], axis=2), axis=1
+    )
+    picked = []
+    for _ in range(min(block_num, candidate_num)):
+        idx = int(np.argmax(nearest))
+        picked.append(candidates[idx])
+        nearest = np.minimum(
+            nearest, np.linalg.norm(candidates - candidates[idx], axis=1)
+        )
+        nearest[idx] = -1
+    return np.array(picked).reshape(-1, knobs_num)
+
+
+def bucket_policy(knobs_num, block_num, seed=None, size=None, chunk_size=1024):
     """
     bucket sample policy. given [a,b] with k buckets.
     produce [a,a+(b-a)/(k-1),a+(b-a)/(k-1)*2,...,b] len = k
+    the grid of k ** knobs_num points is yielded lazily by chunks,
+    with size only a random subset of the grid points is produced.
     """
-    zone = [np.arange(0, 1.0, 1 / block_num) for _ in range(knobs_num)]
-    zone = np.column_stack([item.ravel() for item in np.meshgrid(*zone)])
-    return zone
+    total = block_num**knobs_num
+    if size is None or size >= total:
+        indices = range(total)
+    else:
+        import random
+
+        # sample from range does not materialize the grid
+        indices = sorted(random.Random(seed).sample(range(total), size))
+
+    shape = (block_num,) * knobs_num
+    for start in range(0, len(indices), chunk_size):
+        chunk = np.asarray(indices[start : start + chunk_size], dtype=np.int64)
+        zone = np.column_stack(np.unravel_index(chunk, shape)) / block_num
+        yield zone
+
+
+def _qmc_policy(sampler, block_num, chunk_size):
+    for start in range(0, block_num, chunk_size):
+        yield sampler.random(n=min(chunk_size, block_num - start))
+
+
+def sobol_policy(knobs_num, block_num, seed=None, chunk_size=1024):
+    """scrambled sobol sequence in [0,1] hypercubic, yielded by chunks.
+    block_num is better to be a power of 2 to keep the balance properties.
+    """
+    from scipy.stats import qmc
+
+    sampler = qmc.Sobol(d=knobs_num, seed=seed)
+    return _qmc_policy(sampler, block_num, chunk_size)
+
+
+def halton_policy(knobs_num, block_num, seed=None, chunk_size=1024):
+    """scrambled halton sequence in [0,1] hypercubic, yielded by chunks."""
+    from scipy.stats import qmc
+
+    sampler = qmc.Halton(d=knobs_num, seed=seed)
+    return _qmc_policy(sampler, block_num, chunk_size)
+
+
+def adaptive_policy(
+    knobs_num, block_num, seed=None, history=None, candidate_num=None, maximize=True
+):
+    """
+    model guided sample policy. without history it is the lhs policy,
+    otherwise fit a gaussian process on history and pick the candidates
+    with the largest expected improvement. the batch is spread by adding
+    each picked point with its predicted value before picking the next.
+
+    Args:
+        knobs_num (int): dimension of the hypercubic
+        block_num (int): number of samples in the batch
+        seed (int, optional): random seed. Defaults to None.
+        history (tuple, optional): (X, y) measured, X in [0,1] hypercubic.
+        candidate_num (int, optional): lhs candidates to pick from.
+        maximize (bool, optional): larger metric is better. Defaults to True.
+
+    Returns:
+        np.ndarray: samples in [0,1] hypercubic, shape [block_num, knobs_num]
+    """
+    if history is None or len(history[1]) < 2:
+        return lhs_policy(knobs_num, block_num, seed=seed)
+
+    from scipy.stats import norm
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import ConstantKernel, RBF, WhiteKernel
+
+    X, y = np.asarray(history[0], dtype=float), np.asarray(history[1], dtype=float)
+    if not maximize:
+        y = -y
+    if candidate_num is None:
+        candidate_num = max(1000, 100 * block_num)
+    candidates = lhs_policy(knobs_num, candidate_num, seed=seed)
+
+    kernel = ConstantKernel() * RBF(length_scale=np.ones(knobs_num)) + WhiteKernel()
+    gpr = GaussianProcessRegressor(
+        kernel=kernel, normalize_y=True, random_state=seed
+    ).fit(X, y)
+    best = y.max()
+
+    picked = []
+    for _ in range(block_num):
+        mu, sigma = gpr.predict(candidates, return_std=True)
+        sigma = np.maximum(sigma, 1e-9)
+        improve = mu - best
+        z = improve / sigma
+        ei = improve * norm.cdf(z) + sigma * norm.pdf(z)
+        idx = int(np.argmax(ei))
+        picked.append(candidates[idx])
+        # believe the prediction, refit with the kernel already learned
+        X = np.vstack([X, candidates[idx]])
+        y = np.append(y, mu[idx])
+        candidates = np.delete(candidates, idx, axis=0)
+        gpr = GaussianProcessRegressor(
+            kernel=gpr.kernel_, optimizer=None, normalize_y=True
+        ).fit(X, y)
+    return np.array(picked)
@@ -6,5 +6,11 @@ class BasicWorkload(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def evaluate(self, sample):
+    def evaluate(self, abort_below=None):
         raise NotImplementedError
+
+    def extra_columns(self):
+        """
+        names of the extras evaluate adds to a result, in their order.
+        """
+        return []
@@ -1,23 +1,44 @@
 import os
 import re
+import csv
 import glob
+import time
+import hashlib
+import signal
 import logging
 import subprocess
 
 from string import Template
 from knobtool import constants as my_constants
 from knobtool.workload.basic_workload import BasicWorkload
+from knobtool.workload.steady_state import confidence_interval, find_steady, is_steady
 
 
 class Benchbase(BasicWorkload):
     def __init__(
-        self, is_load=False, metric="through", workload=None, args=None
+        self, is_load=False, metric="through", workload=None, args=None, ogdb=None
     ) -> None:
         self.metric = metric
         self.workload = str(workload).lower()
         self.result_path = None
         self.tmp_xml_path = None
         self.args = args
+        # database the workload runs against
+        self.ogdb = ogdb
+        # "reload": clear, create and load data before every run
+        # "template": load once, then restore the data from a template database
+        self.data_reset = (args or {}).get("data_reset") or "reload"
+        self.is_snapshot = False
+        # interim throughput reported every monitor_interval seconds, the
+        # first abort_grace seconds (warm up) are not used for early abort
+        self.monitor_interval = (args or {}).get("monitor_interval") or 5
+        self.abort_grace = (args or {}).get("abort_grace") or 30
+        # stop the run once the last steady_window interim throughput have a
+        # coefficient of variation within steady_tol, disabled if not set
+        self.steady_window = (args or {}).get("steady_window")
+        self.steady_tol = (args or {}).get("steady_tol") or 0.05
+        # store the delta of the database runtime counters as stat_* extras
+        self.collect_stats = (args or {}).get("collect_stats") or False
         # self_execute
         self.is_load = is_load
 
@@ -26,10 +47,11 @@ class Benchbase(BasicWorkload):
 
         self.base = my_constants.WORKLOAD_TOOL_PATH
         self.result_path = os.path.join(
-            self.base, f"results/{self.workload}_{self.args['db_name']}"
+            self.base,
+            f"results/{self.workload}_{self.args['db_name']}_{self.args['db_port']}",
         )
         self.tmp_xml_path = os.path.join(
-            self.base, f"tmp/sample_{self.workload}_config.xml"
+            self.base, f"tmp/sample_{self.workload}_{self.args['db_port']}_config.xml"
         )
 
         with open(
@@ -52,26 +74,159 @@ class Benchbase(BasicWorkload):
             timeout=None,
         )
 
-    def _execute(self):
+    def fingerprint(self):
+        """
+        identify what is measured, used as a part of the cache key.
+        """
+        template = os.path.join(
+            my_constants.WORKLOAD_TOOL_PATH,
+            f"templates_xml/sample_{self.workload}_config.xml",
+        )
+        with open(template, "rb") as f:
+            template_hash = hashlib.sha256(f.read()).hexdigest()
+        return {
+            "tool": "benchbase",
+            "workload": self.workload,
+            "metric": self.metric,
+            "weights": self.args.get("weights"),
+            "template": template_hash,
+            "abort_grace": self.abort_grace,
+            "steady_window": self.steady_window,
+            "steady_tol": self.steady_tol,
+            "collect_stats": self.collect_stats,
+        }
+
+    def extra_columns(self):
+        columns = []
+        if self.steady_window:
+            columns += ["window_start", "window_end", "ci_low", "ci_high"]
+        if self.collect_stats:
+            from knobtool.database.opengauss import STAT_COLUMNS
+
+            columns += [f"stat_{name}" for name in STAT_COLUMNS]
+        return columns
+
+    def _reset_data(self):
+        """
+        load data at the first run and keep it in a template database,
+        restore it from the template for the later runs.
+        """
+        db_name = self.args["db_name"]
+        template = f"{db_name}_template"
+        if not self.is_snapshot:
+            logging.info(f"loading {self.workload} data into {db_name}")
+            self._execute(phases="--clear=true --create=true --load=true")
+            if not self.ogdb.snapshot_database(db_name, template):
+                raise RuntimeError(f"fail to snapshot {db_name} as {template}")
+            self.is_snapshot = True
+        elif not self.ogdb.restore_database(db_name, template):
+            raise RuntimeError(f"fail to restore {db_name} from {template}")
+
+    def _execute(
+        self,
+        phases="--clear=true --create=true --load=true --execute=true",
+        abort_below=None,
+    ):
+        """
+        run benchbase and parse the interim throughput it reports, stop the
+        run once the throughput after the grace period is below abort_below
+        ("abort") or has converged ("steady").
+        return the interim (seconds, throughput) and the stop reason.
+        """
         current_path = os.getcwd()
         benchbase_run_cmd = (
             f"cd {os.path.join(current_path, self.base)} && "
             + f"java -jar benchbase.jar "
             + f"-b {self.workload} -c {os.path.join(current_path,self.tmp_xml_path)} "
             + f"-d  {os.path.join(current_path,self.result_path)} "
-            + f"--clear=true --create=true --load=true --execute=true"
+            + f"-im {int(self.monitor_interval * 1000)} "
+            + phases
         )
-        collection = subprocess.run(
+        collection = subprocess.Popen(
             benchbase_run_cmd,
             shell=True,
-            input=f"{my_constants.SYS_PASSWD}\n",
-            capture_output=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
             text=True,
-            timeout=None,
+            start_new_session=True,
         )
+        collection.stdin.write(f"{my_constants.SYS_PASSWD}\n")
+        collection.stdin.close()
+
+        output, interim = [], []
+        first_report = None
+        for line in collection.stdout:
+            output.append(line)
+            found = re.search(r"Throughput:\s*(\d+(?:\.\d+)?)\s*txn/sec", line)
+            if found is None:
+                continue
+            # seconds since the execute phase started, the first interim
+            # report comes one interval in. the same time base as the
+            # results csv, clear / create / load are not counted
+            if first_report is None:
+                first_report = time.time()
+            elapsed = time.time() - first_report + self.monitor_interval
+            if elapsed <= self.abort_grace:
+                continue
+            interim.append((elapsed, float(found.group(1))))
+            values = [value for _, value in interim]
+            stop = None
+            if abort_below is not None and sum(values) / len(values) < abort_below:
+                logging.info(
+                    f"port {self.args['db_port']} aborted, throughput "
+                    f"{sum(values) / len(values)} < {abort_below}"
+                )
+                stop = "abort"
+            elif self.steady_window and is_steady(
+                values, self.steady_window, self.steady_tol
+            ):
+                logging.info(f"port {self.args['db_port']} steady after {elapsed}s")
+                stop = "steady"
+            if stop is not None:
+                os.killpg(collection.pid, signal.SIGTERM)
+                collection.wait()
+                return interim, stop
+        collection.wait()
+
+        if collection.returncode != 0:
+            print("".join(output[-50:]))
+        return interim, None
 
-        if collection.stderr != "":
-            print(collection.stderr)
+    def _retrieve_series(self):
+        """
+        per interval (seconds, throughput) from benchbase results csv.
+        """
+        file_list = sorted(glob.glob(os.path.join(self.result_path, "*.results.csv")))
+        if len(file_list) == 0:
+            return []
+        with open(file_list[-1], "r") as f:
+            reader = csv.reader(f)
+            cols = next(reader)
+            through_index = [i for i, c in enumerate(cols) if c.startswith("Throughput")]
+            if len(through_index) == 0:
+                return []
+            return [
+                (float(row[0]), float(row[through_index[0]]))
+                for row in reader
+                if row and float(row[0]) > self.abort_grace
+            ]
+
+    def _window_stats(self, points):
+        """
+        measurement window and 95% confidence interval of the throughput.
+        points are (seconds since the execute phase started, throughput),
+        from the interim reports or the results csv alike.
+        """
+        if len(points) == 0:
+            return dict.fromkeys(["window_start", "window_end", "ci_low", "ci_high"])
+        low, high = confidence_interval([value for _, value in points])
+        return {
+            "window_start": round(points[0][0], 2),
+            "window_end": round(points[-1][0], 2),
+            "ci_low": round(low, 2),
+            "ci_high": round(high, 2),
+        }
 
     def _retrieve_file(self):
         file_list = sorted(list(glob.glob(os.path.join(self.result_path, "*summary*"))))
@@ -113,7 +268,9 @@ class Benchbase(BasicWorkload):
         metric_groups = {metric_name: [] for metric_name in metrics_list}
 
         benchbase_text = self._retrieve_file()
-        logging.info(f"container {self.ogdb.name} test completed, start extracting")
+        logging.info(
+            f"port {self.args['db_port']} test completed, start extracting"
+        )
 
         for metric_name, regular_express in re_dict.items():
             tmp = re.findall(regular_express, benchbase_text)
@@ -130,8 +287,71 @@ class Benchbase(BasicWorkload):
 
         return result
 
-    def evaluate(self):
+    def evaluate(self, abort_below=None):
+        """
+        with abort_below (throughput), a run far below it is stopped early
+        and marked censored, its throughput is the interim average.
+        with steady_window, the throughput is the average over the steady
+        window (after the grace period if never steady).
+        """
         self._produce_xml()
-        self._execute()
-        result = self._retrieve()
+        if self.data_reset == "template":
+            self._reset_data()
+            stats_before = self._snapshot_stats()
+            interim, stop = self._execute(
+                phases="--execute=true", abort_below=abort_below
+            )
+        else:
+            # load in its own call, so the counters cover the execute only
+            self._execute(phases="--clear=true --create=true --load=true")
+            stats_before = self._snapshot_stats()
+            interim, stop = self._execute(
+                phases="--execute=true", abort_below=abort_below
+            )
+        stats_after = self._snapshot_stats()
+
+        if stop is not None:
+            # killed before summary, only the interim throughput is known
+            window = interim[-self.steady_window :] if stop == "steady" else interim
+            values = [value for _, value in window]
+            result = {
+                "through": round(sum(values) / len(values), 2),
+                "censored": stop == "abort",
+            }
+        else:
+            result = self._retrieve()
+            result["censored"] = False
+            window = self._retrieve_series() or interim
+            if self.steady_window:
+                start = find_steady(
+                    [value for _, value in window], self.steady_window, self.steady_tol
+                )
+                if start is None:
+                    logging.info(f"port {self.args['db_port']} never steady")
+                else:
+                    window = window[start:]
+                # the same estimator as a run stopped at steady state, the
+                # summary average includes the warm up. a failed run stays
+                # failed
+                if window and result["through"] is not None:
+                    values = [value for _, value in window]
+                    result["through"] = round(sum(values) / len(values), 2)
+        result["extra"] = {}
+        if self.steady_window:
+            result["extra"].update(self._window_stats(window))
+        if self.collect_stats:
+            result["extra"].update(self._stats_delta(stats_before, stats_after))
         return result
+
+    def _snapshot_stats(self):
+        if not self.collect_stats:
+            return None
+        return self.ogdb.snapshot_stats()
+
+    @staticmethod
+    def _stats_delta(before, after):
+        from knobtool.database.opengauss import STAT_COLUMNS
+
+        if before is None or after is None:
+            return {f"stat_{name}": None for name in STAT_COLUMNS}
+        return {f"stat_{name}": after[name] - before[name] for name in STAT_COLUMNS}
@@ -0,0 +1,44 @@
+import math
+
+
+def coefficient_of_variation(values):
+    n = len(values)
+    mean = sum(values) / n
+    if mean == 0:
+        return math.inf
+    std = math.sqrt(sum((v - mean) ** 2 for v in values) / n)
+    return std / abs(mean)
+
+
+def is_steady(values, window, tol):
+    """
+    the last window values have a coefficient of variation within tol.
+    """
+    if len(values) < window:
+        return False
+    return coefficient_of_variation(values[-window:]) <= tol
+
+
+def find_steady(values, window, tol):
+    """
+    start index of the first window within tol, None if never steady.
+    """
+    for start in range(0, len(values) - window + 1):
+        if coefficient_of_variation(values[start : start + window]) <= tol:
+            return start
+    return None
+
+
+def confidence_interval(values, confidence=0.95):
+    """
+    student t confidence interval of the mean.
+    """
+    from scipy.stats import t
+
+    n = len(values)
+    mean = sum(values) / n
+    if n < 2:
+        return mean, mean
+    std = math.sqrt(sum((v - mean) ** 2 for v in values) / (n - 1))
+    half = t.ppf((1 + confidence) / 2, n - 1) * std / math.sqrt(n)
+    return mean - half, mean + half
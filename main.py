@@ -36,6 +36,12 @@ def get_argv_paser():
         help="collect performance data using two-stage strategy",
     )
 
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue collection from the partial result file",
+    )
+
     parser.add_argument("--rank", action="store_true", help="execute rank command")
 
     parser.add_argument("--evaluate", action="store_true", help="evaluate knob performance for given config")
@@ -67,10 +73,19 @@ def _update_knobtool_constants(config):
     my_constants.DB_BAK_FILE = config["database"]["bak_file"]
     my_constants.DB_LOG_FILE = config["database"]["log_file"]
     my_constants.DB_KNOBS_INFO = config["database"]["knobs_info"]
+    my_constants.DB_READY_TIMEOUT = config["database"].get(
+        "ready_timeout", my_constants.DB_READY_TIMEOUT
+    )
     my_constants.DOCKER_NAME = config["docker"]["name"]
     my_constants.DOCKER_VOLUMN = config["docker"]["volumn"]
+    my_constants.DOCKER_POOL = config["docker"].get("pool") or []
     my_constants.WORKLOAD_NAME = config["workload"]["name"]
     my_constants.WORKLOAD_TOOL_PATH = config["workload"]["tool_path"]
+    rank_config = config.get("rank") or {}
+    my_constants.RANK_WORKERS = rank_config.get("workers")
+    my_constants.RANK_TIMEOUT = rank_config.get("timeout")
+    my_constants.RANK_N_JOBS = rank_config.get("n_jobs")
+    my_constants.RANK_IMPORTANCE = rank_config.get("importance") or {}
     my_constants.SYS_USER = config["system"]["user"]
     my_constants.SYS_PASSWD = config["system"]["password"]  # TODO: replace
 
@@ -94,7 +109,7 @@ def main(argv):
 
     data_file = None
     if args.collect:
-        data_file, _ = collect(config["collect"], args.two_stage)
+        data_file, _ = collect(config["collect"], args.two_stage, resume=args.resume)
 
     if args.rank:
         rank_data = data_file if data_file is not None else my_constants.CM_DATA_PATH
@@ -107,11 +122,16 @@ def main(argv):
                 data_file if data_file is not None else my_constants.CM_DATA_PATH
             )
             model = keutils.load_model()
-            X, y, knobs, _ = keutils.load_data(evaluate_data, normalize=True)
+            X, y, knobs, _, weights = keutils.load_data(
+                evaluate_data, normalize=True, drop_censored=True, with_weights=True
+            )
             watershed = int(0.7 * X.shape[0])
             X_train, _ = (X[:watershed], X[watershed:])
             y_train, _ = (y[:watershed], y[watershed:])
-            keutils.train_model(X_train, y_train, model, knobs)
+            w_train = weights[:watershed] if weights is not None else None
+            keutils.train_model(X_train, y_train, model, knobs, sample_weight=w_train)
+            # only the rules kept by the lasso are saved & pooled
+            model = model.compact()
             keutils.save_model(config["evaluate"]["model_path"], model)
         else:
             evaluate(
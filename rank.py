@@ -1,6 +1,15 @@
 import math
+import time
+import logging
+import traceback
+import multiprocessing
+import numpy as np
 import xgboost as xg
+import knobtool.constants as my_constants
 
+from multiprocessing.connection import wait
+
+from scipy.stats import kendalltau
 from sklearn.linear_model import Lasso
 from knob_evaluator.utils import load_data
 from sklearn.preprocessing import MinMaxScaler
@@ -54,18 +63,210 @@ class RankInfo:
         return sort_rank
 
 
-def create_rank_info(raw_data_path: str):
+def _fit_gpr(X, y, sw=None, ard=False):
+    # ard: one length scale per knob, read by the ard importance
+    kernel = WhiteKernel() + (RBF(length_scale=np.ones(X.shape[1])) if ard else RBF())
+    return GaussianProcessRegressor(kernel=kernel, random_state=0).fit(X, y)
+
+
+def _fit_lasso(X, y, sw=None):
+    return Lasso(alpha=0.03).fit(X, y, sample_weight=sw)
+
+
+def _fit_xgb(X, y, sw=None):
+    xgb_r = xg.XGBRegressor(objective="reg:squarederror", n_estimators=10, seed=123)
+    return xgb_r.fit(X, y, sample_weight=sw)
+
+
+def _fit_mlp(X, y, sw=None):
+    parameter_space = {
+        "hidden_layer_sizes": [(100, 100, 100)],
+        "activation": ["relu"],
+        "solver": ["adam"],
+        "alpha": [0.1, 0.2],
+        "learning_rate": ["constant"],
+    }
+
+    mlp = MLPRegressor(hidden_layer_sizes=20, random_state=1, max_iter=5000)
+    clf = GridSearchCV(mlp, parameter_space, n_jobs=4, cv=3)
+    return clf.fit(X, y.reshape(-1))
+
+
+FIT_FUNCS = {
+    "gpr": _fit_gpr,
+    "lasso": _fit_lasso,
+    "xgb": _fit_xgb,
+    "mlp": _fit_mlp,
+}
+
+
+def _tree_shap_importance(model, X, tX):
+    # mean |shap value| of each knob from the tree paths, bias column dropped
+    contribs = model.get_booster().predict(xg.DMatrix(tX), pred_contribs=True)
+    return np.abs(contribs[:, :-1]).mean(axis=0)
+
+
+def _coef_importance(model, X, tX):
+    return np.abs(np.ravel(model.coef_)) * X.std(axis=0)
+
+
+def _ard_importance(model, X, tX):
+    # kernel_ is WhiteKernel + RBF, short length scales matter more
+    return 1.0 / np.asarray(model.kernel_.k2.length_scale)
+
+
+# engine: (models it applies to, importance func), permutation applies to all
+IMPORTANCE_ENGINES = {
+    "tree_shap": (["xgb"], _tree_shap_importance),
+    "coef": (["lasso"], _coef_importance),
+    "ard": (["gpr"], _ard_importance),
+}
+
+
+def _fit_and_rank(name, X, y, tX, ty, sw=None, n_jobs=None, engine="permutation"):
+    """
+    fit one model, score it on the test split & compute its knob importance,
+    run in a worker process. model-native importances are scaled to sum to
+    the score, like the permutation drops of a model explaining it all.
+    """
+    from joblib import parallel_backend
+
+    # models are already spread over processes, nested jobs use threads
+    # (loky workers started here keep the worker process from exiting)
+    with parallel_backend("threading"):
+        fit = FIT_FUNCS[name]
+        model = fit(X, y, sw, ard=True) if engine == "ard" else fit(X, y, sw)
+        score = model.score(tX, ty)
+        importances = _importance(model, score, engine, X, tX, ty, n_jobs)
+    return model, score, importances
+
+
+def _importance(model, score, engine, X, tX, ty, n_jobs=None):
+    from sklearn.inspection import permutation_importance
+
+    if engine == "permutation":
+        # same seed every time, successive ranks permute alike
+        r = permutation_importance(
+            model, tX, ty.reshape(-1), n_repeats=30, random_state=0, n_jobs=n_jobs
+        )
+        return r.importances_mean
+    importances = IMPORTANCE_ENGINES[engine][1](model, X, tX)
+    total = importances.sum()
+    if total > 0:
+        importances = importances / total * max(score, 0)
+    return importances
+
+
+def _importance_engines(importance):
+    """
+    engine of each model from {model: engine}, permutation by default.
+    """
+    engines = {name: "permutation" for name in FIT_FUNCS}
+    for name, engine in (importance or {}).items():
+        if name not in FIT_FUNCS:
+            raise ValueError(f"unknown rank model {name}")
+        if engine != "permutation" and (
+            engine not in IMPORTANCE_ENGINES or name not in IMPORTANCE_ENGINES[engine][0]
+        ):
+            raise ValueError(f"importance {engine} does not apply to {name}")
+        engines[name] = engine
+    return engines
+
+
+def _rank_worker(conn, name, args, engine):
+    try:
+        conn.send(("ok", _fit_and_rank(name, *args, engine=engine)))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def _run_models(engines, args, workers, timeout):
+    """
+    fit & rank each model in its own process, at most workers at a time.
+    a process still running when its budget runs out is terminated, so it
+    does not take cpu from the benchmarks that follow.
+    returns {model: (model, score, importances)} of the finished ones.
+    """
+    pending = list(FIT_FUNCS)
+    running = {}  # connection: (model, process, deadline)
+    results = {}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                name = pending.pop(0)
+                recv, send = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(
+                    target=_rank_worker, args=(send, name, args, engines[name])
+                )
+                process.start()
+                send.close()
+                budget = timeout.get(name) if isinstance(timeout, dict) else timeout
+                deadline = None if budget is None else time.time() + budget
+                running[recv] = (name, process, deadline)
+
+            deadlines = [d for _, _, d in running.values() if d is not None]
+            wait_time = max(0, min(deadlines) - time.time()) if deadlines else None
+            for conn in wait(list(running), wait_time):
+                name, process, _ = running.pop(conn)
+                try:
+                    status, value = conn.recv()
+                except EOFError:
+                    status, value = "error", f"exit code {process.exitcode}"
+                conn.close()
+                process.join()
+                if status == "error":
+                    raise RuntimeError(f"rank: {name} failed\n{value}")
+                results[name] = value
+
+            now = time.time()
+            for conn, (name, process, deadline) in list(running.items()):
+                if deadline is not None and now >= deadline and not conn.poll():
+                    logging.warning(f"rank: {name} exceeds its budget, terminated")
+                    del running[conn]
+                    process.terminate()
+                    process.join()
+                    conn.close()
+    finally:
+        # an error in one model stops the others too
+        for conn, (_, process, _) in running.items():
+            process.terminate()
+            process.join()
+            conn.close()
+    return results
+
+
+def create_rank_info(
+    raw_data_path: str, use_weights=True, workers=None, timeout=None, importance=None
+):
+    """
+    workers: processes fitting the models, timeout: seconds each model may
+    take, a number or {model: seconds}. models over their budget are
+    terminated and left out of the rank. importance: {model: engine},
+    permutation (default), tree_shap (xgb), coef (lasso) or ard (gpr).
+    """
+    workers = workers or my_constants.RANK_WORKERS or len(FIT_FUNCS)
+    timeout = timeout if timeout is not None else my_constants.RANK_TIMEOUT
+    engines = _importance_engines(
+        importance if importance is not None else my_constants.RANK_IMPORTANCE
+    )
     # basic model
     models = {}
     models_performance = {}
     models_rank = {}
-    X, y, knobs, _ = load_data(raw_data_path)
+    # censored rows hold a truncated interim average, not a measurement
+    X, y, knobs, _, weights = load_data(
+        raw_data_path, drop_censored=True, with_weights=True
+    )
     y = y.reshape(-1, 1)
     data_size = len(y)
 
     watershed = int(0.7 * data_size)
     X, tX = X[:watershed], X[watershed:]
     y, ty = y[:watershed], y[watershed:]
+    # inverse variance weights of repeated measurements
+    sw = weights[:watershed] if use_weights and weights is not None else None
 
     mms = MinMaxScaler()
     mms.fit(X)
@@ -73,45 +274,15 @@ def create_rank_info(raw_data_path: str):
     mms.fit(y)
     y, ty = mms.transform(y), mms.transform(ty)
 
-    kernel = WhiteKernel() + RBF()
-    gpr = GaussianProcessRegressor(kernel=kernel, random_state=0).fit(X, y)
-    models["gpr"] = gpr
-    models_performance["gpr"] = gpr.score(tX, ty)
-
-    linear = Lasso(alpha=0.03).fit(X, y)
-    models["lasso"] = linear
-    models_performance["lasso"] = linear.score(tX, ty)
-
-    xgb_r = xg.XGBRegressor(objective="reg:squarederror", n_estimators=10, seed=123)
-    xgb_r.fit(X, y)
-    models["xgb"] = xgb_r
-    models_performance["xgb"] = xgb_r.score(tX, ty)
-
-    ty, y = ty.reshape(
-        -1,
-    ), y.reshape(
-        -1,
-    )
-    parameter_space = {
-        "hidden_layer_sizes": [(100, 100, 100)],
-        "activation": ["relu"],
-        "solver": ["adam"],
-        "alpha": [0.1, 0.2],
-        "learning_rate": ["constant"],
-    }
-
-    mlp = MLPRegressor(hidden_layer_sizes=20, random_state=1, max_iter=5000)
-    clf = GridSearchCV(mlp, parameter_space, n_jobs=4, cv=3)
-    clf.fit(X, y)
-    models["mlp"] = clf
-    models_performance["mlp"] = clf.score(tX, ty)
-    for name, model in models.items():
-        from sklearn.inspection import permutation_importance
-
-        r = permutation_importance(model, tX, ty, n_repeats=30, random_state=0)
-        models_rank[name] = [
-            (knobs[i], r.importances_mean[i]) for i in range(len(knobs))
-        ]
+    args = (X, y, tX, ty, sw, my_constants.RANK_N_JOBS)
+    for name, (model, score, importances) in _run_models(
+        engines, args, workers, timeout
+    ).items():
+        models[name] = model
+        models_performance[name] = score
+        models_rank[name] = [(knobs[i], importances[i]) for i in range(len(knobs))]
+    if not models_rank:
+        raise RuntimeError("rank: no model finished within its budget")
     unit = RankInfo(
         size=data_size,
         models=models,
@@ -121,6 +292,123 @@ def create_rank_info(raw_data_path: str):
     return unit
 
 
+class IncrementalRanker:
+    """
+    knob rank updated while rows are collected, usable as the collector
+    monitor. every step new rows the gpr, lasso & xgb models are refitted
+    (gpr from the last kernel hyperparameters, lasso from the last coef)
+    and the rank is compared with the previous one. stable once the top_k
+    knobs stay the same for patience updates.
+    """
+
+    def __init__(
+        self,
+        knobs,
+        metric,
+        top_k=6,
+        patience=3,
+        step=5,
+        min_rows=10,
+        importance=None,
+    ) -> None:
+        self.knobs = knobs
+        self.metric = metric
+        self.top_k = top_k
+        self.patience = patience
+        self.step = step
+        self.min_rows = min_rows
+        self.engines = _importance_engines(
+            importance if importance is not None else my_constants.RANK_IMPORTANCE
+        )
+        self.models = {}
+        self.rank = None
+        self.taus = []  # kendall tau between successive ranks
+        self.unchanged = 0
+        self.seen = 0
+
+    @property
+    def stable(self):
+        return self.unchanged >= self.patience
+
+    def __call__(self, rows):
+        """
+        collector monitor, True stops the collection.
+        """
+        self.update(rows)
+        return self.stable
+
+    def update(self, rows):
+        rows = [
+            row
+            for row in rows
+            if row[self.metric] not in (None, "") and not int(row.get("censored") or 0)
+        ]
+        if len(rows) < max(self.min_rows, 2) or len(rows) - self.seen < self.step:
+            return self.rank
+        self.seen = len(rows)
+
+        X = self.knobs.decoder.encode(rows)
+        y = np.array([float(row[self.metric]) for row in rows]).reshape(-1, 1)
+        watershed = int(0.7 * len(y))
+        X, tX = X[:watershed], X[watershed:]
+        y, ty = y[:watershed], y[watershed:]
+        mms = MinMaxScaler()
+        mms.fit(y)
+        y, ty = mms.transform(y), mms.transform(ty)
+
+        models_performance = {}
+        models_rank = {}
+        for name, model in self._fit(X, y).items():
+            score = model.score(tX, ty)
+            importances = _importance(
+                model, score, self.engines[name], X, tX, ty, my_constants.RANK_N_JOBS
+            )
+            models_performance[name] = score
+            names = self.knobs.decoder.names
+            models_rank[name] = [(knob, importances[i]) for i, knob in enumerate(names)]
+        rank = RankInfo(
+            size=len(rows),
+            models=self.models,
+            models_performance=models_performance,
+            models_rank=models_rank,
+        ).rank
+
+        if self.rank is not None:
+            last, order = list(self.rank.keys()), list(rank.keys())
+            tau, _ = kendalltau(
+                [last.index(knob) for knob in order], list(range(len(order)))
+            )
+            self.taus.append(tau)
+            if set(last[: self.top_k]) == set(order[: self.top_k]):
+                self.unchanged += 1
+            else:
+                self.unchanged = 0
+            logging.info(
+                f"rank on {len(rows)} rows, kendall tau {tau:.3f}, "
+                f"top {self.top_k} unchanged for {self.unchanged} updates"
+            )
+        self.rank = rank
+        return self.rank
+
+    def _fit(self, X, y):
+        if "gpr" in self.models:
+            kernel = self.models["gpr"].kernel_
+        elif self.engines["gpr"] == "ard":
+            kernel = WhiteKernel() + RBF(length_scale=np.ones(X.shape[1]))
+        else:
+            kernel = WhiteKernel() + RBF()
+        self.models["gpr"] = GaussianProcessRegressor(kernel=kernel, random_state=0).fit(
+            X, y
+        )
+        if "lasso" not in self.models:
+            self.models["lasso"] = Lasso(alpha=0.03, warm_start=True)
+        self.models["lasso"].fit(X, y)
+        # 10 trees are cheap to grow again, boosting on would stack trees
+        # fitted to the residuals of older rows
+        self.models["xgb"] = _fit_xgb(X, y)
+        return self.models
+
+
 def rank(data_path):
     f = lambda x: [(name, round(value, 3)) for name, value in x.items()]
     rank_info = create_rank_info(data_path)